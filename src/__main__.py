@@ -16,6 +16,15 @@ def parse_args():
     create_db_parser.add_argument('--classes', nargs='*', 
         help='(optional) specify classes to select in source folder')
     create_db_parser.add_argument('--from', type=str, required=True, help='path to the source folder (here coreldb)')
+    create_db_parser.add_argument('--prepare', action='store_true', help='also write resized images in shards')
+    create_db_parser.add_argument('--mode', choices=('copy', 'hardlink', 'symlink', 'manifest'), default='copy',
+        help='copy images, link them, or only list them in manifest.csv')
+    create_db_parser.add_argument('--seed', type=int, default=None, help='seed of the split, for reproducible databases')
+
+    # parse arguments to write the shards of an existing database
+    prepare_db_parser = subparsers.add_parser('prepare-database')
+    prepare_db_parser.set_defaults(action='prepare-database')
+    prepare_db_parser.add_argument('--size', type=int, nargs=2, default=(150, 150), help='height and width of images')
 
     # parse arguments to train CNN
     train_cnn_parser = subparsers.add_parser('train-cnn')
@@ -23,11 +32,36 @@ def parse_args():
     train_cnn_parser.add_argument('-b', '--batch_size', type=int, default=16, help='batch size')
     train_cnn_parser.add_argument('-e', '--epochs', type=int, default=15, help='epochs')
     train_cnn_parser.add_argument('--history', action='store_true', help='plot training history')
+    train_cnn_parser.add_argument('--backend', choices=('keras', 'tf.data'), default='keras', help='image loader')
+    train_cnn_parser.add_argument('--cache', type=str, default=None,
+        help='(tf.data) cache decoded images, in memory if empty or in the given file')
 
     # parse arguments to classify image using trained CNN
     cnn_classify_parser = subparsers.add_parser('cnn-classify')
     cnn_classify_parser.set_defaults(action='cnn-classify')
     cnn_classify_parser.add_argument('--confusion', action='store_true', help='plot confusion matrix after testing')
+    cnn_classify_parser.add_argument('-o', '--output', type=str, default=None,
+        help='predictions file, .csv or .parquet (default: database/predictions.csv)')
+    cnn_classify_parser.add_argument('--folders', choices=('hardlink', 'symlink', 'copy'), default=None,
+        help='also sort test images in results/ and miss/ folders')
+
+    # parse arguments to classify any images with the trained CNN
+    predict_parser = subparsers.add_parser('predict')
+    predict_parser.set_defaults(action='predict')
+    predict_parser.add_argument('sources', nargs='+',
+        help='folders of images, images, or text files listing one image path per line')
+    predict_parser.add_argument('-o', '--output', type=str, default='predictions.csv',
+        help='predictions file, .csv or .parquet')
+    predict_parser.add_argument('-b', '--batch_size', type=int, default=64, help='batch size')
+    predict_parser.add_argument('-t', '--threads', type=int, default=4, help='decoding threads')
+
+    # parse arguments to compare image loaders
+    benchmark_parser = subparsers.add_parser('benchmark-loader')
+    benchmark_parser.set_defaults(action='benchmark-loader')
+    benchmark_parser.add_argument('-b', '--batch_size', type=int, default=16, help='batch size')
+    benchmark_parser.add_argument('-e', '--epochs', type=int, default=2, help='epochs timed per loader')
+    benchmark_parser.add_argument('--subfolder', type=str, default='train', help='subfolder of the database')
+    benchmark_parser.add_argument('--cache', type=str, default=None, help='also time tf.data with a disk cache')
 
     #
     args = parser.parse_args()
@@ -43,14 +77,19 @@ def main():
     args = parse_args()
 
     if args.action == 'create-database':
-        Database.create(DATABASE_NAME, getattr(args, 'from'), classes=args.classes)
+        Database.create(DATABASE_NAME, getattr(args, 'from'), classes=args.classes, prepare=args.prepare,
+                mode=args.mode, seed=args.seed)
+
+    elif args.action == 'prepare-database':
+        Database(DATABASE_NAME).prepare(target_size=tuple(args.size))
     
     elif args.action == 'train-cnn':
         from .convolutional_nn import CNNClassifier
         database = Database(DATABASE_NAME)
         model = CNNClassifier(len(database))
         model.train(database, batch_size=args.batch_size, 
-                epochs=args.epochs, history=args.history, overwrite=True)
+                epochs=args.epochs, history=args.history, overwrite=True,
+                backend=args.backend, cache=args.cache)
 
     elif args.action == 'cnn-classify':
         from .convolutional_nn import CNNClassifier
@@ -58,7 +97,28 @@ def main():
         model = CNNClassifier(len(database))
         # this step is skipped if model exists
         model.train(database, overwrite=False)
-        model.classify_test_images(database, confusion_matrix=args.confusion)
+        output = model.classify_test_images(database, confusion_matrix=args.confusion,
+                output=args.output, folders=args.folders)
+        print('Predictions written to {}'.format(output))
+
+    elif args.action == 'predict':
+        from .convolutional_nn import CNNClassifier
+        from .database import iter_image_paths
+        database = Database(DATABASE_NAME)
+        if not database.weights_exists:
+            sys.exit('No trained model in {}, run train-cnn first.'.format(database.path))
+        model = CNNClassifier(len(database))
+        model.load_weights(database.weights_filename)
+        model.predict_paths(iter_image_paths(args.sources), args.output, database.classes,
+                batch_size=args.batch_size, n_threads=args.threads)
+
+    elif args.action == 'benchmark-loader':
+        from .loader_benchmark import benchmark_loaders
+        database = Database(DATABASE_NAME)
+        results = benchmark_loaders(database, args.subfolder, batch_size=args.batch_size,
+                epochs=args.epochs, cache_file=args.cache)
+        for name, speeds in results.items():
+            print('{:<24} {}'.format(name, ', '.join('{:.1f} images/sec'.format(s) for s in speeds)))
         
 
 
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from evaluate import SampleIndex, distance_matrix, distance_rows, _average_precision, _top_k
+from feature_store import FeatureStore
+
+import numpy as np
+import json
+import time
+import os
+
+
+''' Approximate nearest neighbour indexes
+
+    every index selects a few candidate samples for a query, which are then ranked with the exact
+    distance, so query() returns the same (ap, results) as evaluate.infer over those candidates
+
+      IVFIndex   : k-means coarse quantizer, a query scans the n_probe closest lists
+      LSHIndex   : locality sensitive hashing, random hyperplanes for cosine,
+                   Cauchy (L1) or gaussian (L2) p-stable projections for distances
+      RPTreeIndex: forest of sparse random projection trees, a query scans one leaf per tree
+'''
+
+
+def _kmeans(X, k, n_iter=20, seed=0):
+  ''' Lloyd's k-means with squared euclidean distance
+
+    return
+      (centroids with shape (k, dims), cluster of each row of X)
+  '''
+  rng = np.random.RandomState(seed)
+  X = np.asarray(X, dtype=np.float32)
+  k = min(k, len(X))
+  centroids = X[rng.choice(len(X), k, replace=False)].copy()
+  sq_norms = np.einsum('ij,ij->i', X, X)
+  for _ in range(n_iter):
+    dis = sq_norms[:, None] - 2 * np.dot(X, centroids.T) + np.einsum('ij,ij->i', centroids, centroids)[None, :]
+    assign = np.argmin(dis, axis=1)
+    counts = np.bincount(assign, minlength=k)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, assign, X)
+    empty = counts == 0
+    centroids[~empty] = sums[~empty] / counts[~empty, None]
+    # empty clusters restart from random samples
+    centroids[empty] = X[rng.choice(len(X), np.count_nonzero(empty))]
+  return centroids, assign
+
+
+def _matrix_index(hist):
+  ''' SampleIndex over a plain matrix, e.g. centroids '''
+  n = len(hist)
+  return SampleIndex(FeatureStore.from_arrays(hist, np.arange(n).astype(str), np.zeros(n, dtype=int)))
+
+
+class ANNIndex(object):
+  ''' base class of approximate indexes, subclasses implement _build, _candidates and the
+      arrays / params attributes saved with the index
+
+    arguments
+      d_type: distance type used to rank candidates
+      seed  : seed of the random choices made while building
+  '''
+
+  arrays = ()
+  params = ()
+
+  def __init__(self, d_type='d1', seed=0):
+    self.d_type = d_type
+    self.seed   = seed
+    self.index  = None
+
+  def build(self, samples):
+    ''' index samples, a list made by make_samples, a FeatureStore or a SampleIndex '''
+    self.index = samples if isinstance(samples, SampleIndex) else SampleIndex(samples)
+    self._build()
+    return self
+
+  def __len__(self):
+    return len(self.index)
+
+  def _build(self):
+    raise NotImplementedError("Needs to implemented this method")
+
+  def _candidates(self, q_hist):
+    raise NotImplementedError("Needs to implemented this method")
+
+  def search(self, q_hist, q_img=None, depth=None, d_type=None):
+    ''' rows and distances of the closest candidates of a query histogram
+
+      return
+        (rows in the index sorted by distance, their distances)
+    '''
+    d_type = d_type or self.d_type
+    rows = np.unique(self._candidates(np.asarray(q_hist, dtype=self.index.dtype)))
+    if q_img is not None:
+      rows = rows[self.index.img[rows] != q_img]
+    dis = distance_rows(q_hist, self.index, rows, d_type=d_type)[0] if len(rows) else np.empty(0)
+    k = min(depth, len(dis)) if depth else len(dis)
+    top = _top_k(dis, k)
+    return rows[top], dis[top]
+
+  def query(self, query, depth=None, d_type=None):
+    ''' infer a query like evaluate.infer, among the candidates of the index
+
+      arguments
+        query : a dict {'img': <path_to_img>, 'cls': <img class>, 'hist' <img histogram>}
+        depth : retrieved depth, None returns every candidate
+        d_type: distance type, defaults to the one of the index
+
+      return
+        (ap, results) as evaluate.infer
+    '''
+    rows, dis = self.search(query['hist'], q_img=query['img'], depth=depth, d_type=d_type)
+    cls = self.index.cls[rows]
+    results = [{'dis': float(d), 'cls': c} for d, c in zip(dis, cls)]
+    return _average_precision(cls == query['cls']), results
+
+  def save(self, path):
+    ''' save the index structure and its samples store in a directory '''
+    if not os.path.exists(path):
+      os.makedirs(path)
+    self.index.store.save(os.path.join(path, 'store'))
+    np.savez(os.path.join(path, 'index.npz'), **{name: getattr(self, name) for name in self.arrays})
+    meta = {'type': type(self).__name__, 'd_type': self.d_type, 'seed': self.seed}
+    meta.update({name: getattr(self, name) for name in self.params})
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='UTF-8') as f:
+      json.dump(meta, f)
+
+
+def load_index(path):
+  ''' load an index saved with ANNIndex.save, its samples matrix is memory-mapped '''
+  with open(os.path.join(path, 'meta.json'), encoding='UTF-8') as f:
+    meta = json.load(f)
+  ann = index_types[meta.pop('type')](**meta)
+  ann.index = SampleIndex(FeatureStore.load(os.path.join(path, 'store')))
+  with np.load(os.path.join(path, 'index.npz')) as arrays:
+    for name in ann.arrays:
+      setattr(ann, name, arrays[name])
+  return ann
+
+
+class IVFIndex(ANNIndex):
+  ''' inverted file index: samples are grouped by their closest k-means centroid
+
+    arguments
+      n_lists: number of centroids, sqrt(n_samples) is a common choice
+      n_probe: number of lists scanned by a query
+      n_train: number of samples used to train k-means
+      n_iter : k-means iterations
+  '''
+
+  arrays = ('centroids', 'list_ids', 'list_offsets')
+  params = ('n_lists', 'n_probe', 'n_train', 'n_iter')
+
+  def __init__(self, n_lists=256, n_probe=8, n_train=20000, n_iter=20, d_type='d1', seed=0):
+    super(IVFIndex, self).__init__(d_type=d_type, seed=seed)
+    self.n_lists = n_lists
+    self.n_probe = n_probe
+    self.n_train = n_train
+    self.n_iter  = n_iter
+
+  def _build(self):
+    hist = self.index.hist
+    rng = np.random.RandomState(self.seed)
+    train = np.sort(rng.choice(len(hist), min(self.n_train, len(hist)), replace=False))
+    self.centroids, _ = _kmeans(hist[train], self.n_lists, n_iter=self.n_iter, seed=self.seed)
+
+    # assign every sample with the index distance, by blocks to bound memory
+    self._centroid_index = None
+    centroid_index = self.centroid_index
+    assign = np.empty(len(hist), dtype=np.intp)
+    for start in range(0, len(hist), 4096):
+      dis = distance_matrix(hist[start:start+4096], centroid_index, d_type=self.d_type)
+      assign[start:start+4096] = np.argmin(dis, axis=1)
+
+    self.list_ids = np.argsort(assign, kind='stable')
+    self.list_offsets = np.searchsorted(assign[self.list_ids], np.arange(len(self.centroids)+1))
+
+  @property
+  def centroid_index(self):
+    if getattr(self, '_centroid_index', None) is None:
+      self._centroid_index = _matrix_index(self.centroids)
+    return self._centroid_index
+
+  def _candidates(self, q_hist):
+    dis = distance_matrix(q_hist, self.centroid_index, d_type=self.d_type)[0]
+    probes = np.argsort(dis)[:self.n_probe]
+    return np.concatenate([self.list_ids[self.list_offsets[p]:self.list_offsets[p+1]] for p in probes])
+
+
+class LSHIndex(ANNIndex):
+  ''' locality sensitive hashing with n_tables tables of n_bits hashes each
+
+    the family follows d_type: sign of random hyperplanes for cosine and d2-norm, Cauchy
+    projections (1-stable) for d1, gaussian projections (2-stable) for d2 and square
+
+    arguments
+      n_tables    : number of hash tables, more tables give more candidates
+      n_bits      : number of hashes per table, more hashes give smaller buckets
+      bucket_width: width of p-stable buckets, estimated from samples pairs if None
+  '''
+
+  arrays = ('center', 'projections', 'offsets', 'mixer', 'table_keys', 'table_ids')
+  params = ('n_tables', 'n_bits', 'bucket_width')
+
+  def __init__(self, n_tables=16, n_bits=8, bucket_width=None, d_type='cosine', seed=0):
+    super(LSHIndex, self).__init__(d_type=d_type, seed=seed)
+    self.n_tables     = n_tables
+    self.n_bits       = n_bits
+    self.bucket_width = bucket_width
+
+  @property
+  def family(self):
+    if self.d_type in ('cosine', 'd2-norm', 'd7', 'd8'):
+      return 'hyperplane'
+    elif self.d_type == 'd1':
+      return 'cauchy'
+    return 'gaussian'
+
+  def _hash(self, hist):
+    ''' key of each row of hist in every table, with shape (n_rows, n_tables) '''
+    proj = np.dot(np.atleast_2d(hist) - self.center, self.projections.T).reshape(-1, self.n_tables, self.n_bits)
+    if self.family == 'hyperplane':
+      h = (proj > 0).astype(np.int64)
+    else:
+      h = np.floor((proj + self.offsets.reshape(self.n_tables, self.n_bits)) / self.bucket_width).astype(np.int64)
+    # integer overflow only wraps the key around, which is fine for hashing
+    with np.errstate(over='ignore'):
+      return np.sum(h * self.mixer, axis=2)
+
+  def _build(self):
+    hist = self.index.hist
+    rng = np.random.RandomState(self.seed)
+    shape = (self.n_tables * self.n_bits, hist.shape[1])
+    if self.family == 'cauchy':
+      self.projections = rng.standard_cauchy(shape).astype(np.float32)
+    else:
+      self.projections = rng.standard_normal(shape).astype(np.float32)
+
+    if self.family == 'hyperplane':
+      # histograms are all positive, hyperplanes go through their mean rather than the origin
+      self.center = np.asarray(np.mean(hist[rng.randint(0, len(hist), size=min(10000, len(hist)))], axis=0),
+                               dtype=np.float32)
+      self.mixer = (1 << np.arange(self.n_bits, dtype=np.int64))
+      self.offsets = np.zeros(0, dtype=np.float32)
+    else:
+      self.center = np.zeros(hist.shape[1], dtype=np.float32)
+      self.mixer = rng.randint(1, 2**31, size=self.n_bits).astype(np.int64) * 2 + 1
+      if self.bucket_width is None:
+        # a few times the typical projected distance between two random samples
+        pairs = rng.randint(0, len(hist), size=(min(1000, len(hist)), 2))
+        diff = np.dot(hist[pairs[:, 0]] - hist[pairs[:, 1]], self.projections[:self.n_bits].T)
+        self.bucket_width = 4 * float(np.median(np.abs(diff))) or 1.
+      self.offsets = rng.uniform(0, self.bucket_width, size=shape[0]).astype(np.float32)
+
+    keys = np.empty((len(hist), self.n_tables), dtype=np.int64)
+    for start in range(0, len(hist), 4096):
+      keys[start:start+4096] = self._hash(hist[start:start+4096])
+    self.table_ids = np.argsort(keys, axis=0, kind='stable').T
+    self.table_keys = np.take_along_axis(keys.T, self.table_ids, axis=1)
+
+  def _candidates(self, q_hist):
+    keys = self._hash(q_hist)[0]
+    found = []
+    for t, key in enumerate(keys):
+      lo, hi = np.searchsorted(self.table_keys[t], [key, key+1])
+      found.append(self.table_ids[t, lo:hi])
+    return np.concatenate(found)
+
+
+class RPTreeIndex(ANNIndex):
+  ''' forest of random projection trees
+
+    every node splits its samples at the median of a sparse random direction, made of
+    n_coords coordinates with random signs, until leaves hold at most leaf_size samples
+
+    arguments
+      n_trees  : number of trees, a query gathers one leaf per tree
+      leaf_size: maximum number of samples in a leaf
+      n_coords : number of coordinates of each split direction
+  '''
+
+  arrays = ('roots', 'node_coords', 'node_signs', 'node_thr', 'node_children', 'leaf_offsets', 'leaf_ids')
+  params = ('n_trees', 'leaf_size', 'n_coords')
+
+  def __init__(self, n_trees=8, leaf_size=64, n_coords=32, d_type='d1', seed=0):
+    super(RPTreeIndex, self).__init__(d_type=d_type, seed=seed)
+    self.n_trees   = n_trees
+    self.leaf_size = leaf_size
+    self.n_coords  = n_coords
+
+  def _build(self):
+    hist = self.index.hist
+    n, dims = hist.shape
+    n_coords = min(self.n_coords, dims)
+    rng = np.random.RandomState(self.seed)
+
+    coords, signs, thr, children, leaves = [], [], [], [], []
+    roots = []
+    for _ in range(self.n_trees):
+      roots.append(len(thr))
+      stack = [(len(thr), np.arange(n))]
+      coords.append(None), signs.append(None), thr.append(0.), children.append((-1, -1))
+      while stack:
+        node, ids = stack.pop()
+        c = rng.choice(dims, n_coords, replace=False)
+        sg = rng.choice([-1., 1.], n_coords)
+        proj = np.dot(hist[np.ix_(ids, c)], sg)
+        median = np.median(proj)
+        left = proj <= median
+        if len(ids) <= self.leaf_size or left.all() or not left.any():
+          # leaves store -1 - their leaf number as children
+          children[node] = (-1 - len(leaves), -1 - len(leaves))
+          coords[node], signs[node] = np.zeros(n_coords, dtype=np.int64), np.zeros(n_coords)
+          leaves.append(ids)
+          continue
+        coords[node], signs[node], thr[node] = c, sg, median
+        kids = []
+        for part in (ids[left], ids[~left]):
+          kids.append(len(thr))
+          stack.append((len(thr), part))
+          coords.append(None), signs.append(None), thr.append(0.), children.append((-1, -1))
+        children[node] = tuple(kids)
+
+    self.roots         = np.array(roots, dtype=np.int64)
+    self.node_coords   = np.array(coords, dtype=np.int64)
+    self.node_signs    = np.array(signs, dtype=np.float32)
+    self.node_thr      = np.array(thr, dtype=np.float32)
+    self.node_children = np.array(children, dtype=np.int64)
+    self.leaf_offsets  = np.cumsum([0] + [len(ids) for ids in leaves])
+    self.leaf_ids      = np.concatenate(leaves) if leaves else np.empty(0, dtype=np.intp)
+
+  def _candidates(self, q_hist):
+    found = []
+    for node in self.roots:
+      while self.node_children[node, 0] >= 0:
+        proj = np.dot(q_hist[self.node_coords[node]], self.node_signs[node])
+        node = self.node_children[node, 0 if proj <= self.node_thr[node] else 1]
+      leaf = -1 - self.node_children[node, 0]
+      found.append(self.leaf_ids[self.leaf_offsets[leaf]:self.leaf_offsets[leaf+1]])
+    return np.concatenate(found)
+
+
+index_types = {cls.__name__: cls for cls in (IVFIndex, LSHIndex, RPTreeIndex)}
+
+
+def recall_report(ann, queries=None, n_queries=100, depth=10, d_type=None, seed=0, verbose=True, reference=None):
+  ''' compare an approximate index with the exact linear scan of evaluate.infer
+
+    arguments
+      ann      : a built ANNIndex
+      queries  : rows of the index used as queries, n_queries random rows if None
+      depth    : retrieved depth
+      d_type   : distance type, defaults to the one of the index
+      reference: SampleIndex or samples holding the full histograms the index was built from,
+                 used for the queries and the exact scan, defaults to ann.index
+                 compressed indexes don't keep the histograms and need it
+
+    return
+      a dict with the mean recall@depth, the mean exact and approximate ap,
+      the mean latencies in milliseconds and the mean number of candidates
+  '''
+  d_type = d_type or ann.d_type
+  index = ann.index
+  if reference is not None:
+    index = reference if isinstance(reference, SampleIndex) else SampleIndex.of(reference)
+    assert len(index) == len(ann.index), "reference has %d samples, the index %d!" % (len(index), len(ann.index))
+  elif index.hist.shape[1] == 0:
+    raise ValueError("%s doesn't keep the histograms, pass the reference features" % type(ann).__name__)
+  if queries is None:
+    queries = np.random.RandomState(seed).choice(len(index), min(n_queries, len(index)), replace=False)
+
+  recalls, exact_aps, ann_aps, exact_time, ann_time, n_candidates = [], [], [], 0., 0., []
+  for row in queries:
+    q_hist, q_img, q_cls = index.hist[row], index.img[row], index.cls[row]
+
+    start = time.time()
+    dis = distance_matrix(q_hist, index, d_type=d_type)[0]
+    candidates = np.flatnonzero(index.img != q_img)
+    exact = candidates[_top_k(dis[candidates], min(depth, len(candidates)))]
+    exact_time += time.time() - start
+
+    start = time.time()
+    approx, _ = ann.search(q_hist, q_img=q_img, depth=depth, d_type=d_type)
+    ann_time += time.time() - start
+
+    n_candidates.append(len(np.unique(ann._candidates(np.asarray(q_hist)))))
+    recalls.append(len(np.intersect1d(exact, approx)) / float(max(len(exact), 1)))
+    exact_aps.append(_average_precision(index.cls[exact] == q_cls))
+    ann_aps.append(_average_precision(index.cls[approx] == q_cls))
+
+  report = {
+    'index': type(ann).__name__,
+    'd_type': d_type,
+    'depth': depth,
+    'n_samples': len(index),
+    'n_queries': len(queries),
+    'recall': float(np.mean(recalls)),
+    'exact_MAP': float(np.mean(exact_aps)),
+    'ann_MAP': float(np.mean(ann_aps)),
+    'exact_ms': 1000 * exact_time / len(queries),
+    'ann_ms': 1000 * ann_time / len(queries),
+    'candidates': float(np.mean(n_candidates)),
+  }
+  if verbose:
+    print("{index}, {d_type}, depth {depth}: recall {recall:.3f}, MAP {ann_MAP:.3f} (exact {exact_MAP:.3f}), "
+          "{ann_ms:.2f} ms (exact {exact_ms:.2f} ms), {candidates:.0f} candidates".format(**report))
+  return report
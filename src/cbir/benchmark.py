@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from database import Database
+from evaluate import SampleIndex, infer, evaluate_class
+from extraction import n_workers
+from image_loader import iter_batches
+from PIL import Image
+
+import multiprocessing
+import numpy as np
+import platform
+import argparse
+import shutil
+import json
+import time
+import sys
+import os
+
+
+''' Benchmark suite
+
+    generates a synthetic labelled image tree, laid out as Database expects (one folder of .jpg
+    per class), then times every stage of the CBIR pipeline on it and reports a JSON document
+
+      generate        : writing the synthetic images, skipped for images already written
+      decode          : decoding every image with image_loader
+      extraction      : extracting each feature with an empty cache, per image
+      cache_load      : making the samples of each feature from an up to date cache
+      infer           : latency of a single query against a prebuilt SampleIndex
+      evaluate_class  : inferring the whole database with each feature
+      fusion_sweep    : fusion.evaluate_sweep over the features
+      projection_sweep: random_projection.evaluate_sweep over the features
+
+    the images mimic the Corel database: each class draws its pixels around a few dominant
+    colors and stripes of a dominant orientation, with enough noise for classes to overlap
+'''
+
+
+# configs for the benchmark
+n_images   = 1000
+n_classes  = 10
+image_size = (96, 128)   # (height, width) of the synthetic images
+n_queries  = 100
+depth      = 10
+d_type     = 'd1'
+features   = ['color', 'edge']
+seed       = 0
+
+
+def _class_style(cls, seed=seed):
+  ''' dominant colors and stripe orientation of a class '''
+  rng = np.random.RandomState([seed, cls])
+  return rng.randint(0, 256, size=(3, 3)), rng.uniform(0, np.pi)
+
+
+def make_image(cls, idx, size=image_size, seed=seed):
+  ''' synthetic image number idx of class cls, the same arguments always give the same image '''
+  colors, angle = _class_style(cls, seed)
+  rng = np.random.RandomState([seed, cls, idx])
+  h, w = size
+  yy, xx = np.mgrid[0:h, 0:w]
+  period = rng.uniform(6, 24)
+  phase = np.cos(angle + rng.normal(0, 0.3)) * xx + np.sin(angle + rng.normal(0, 0.3)) * yy
+  stripes = (np.floor(phase / period).astype(int) + rng.randint(3)) % 3
+  # every image shifts the colors of its class, then pixels get noise
+  shifted = colors + rng.normal(0, 48, size=colors.shape)
+  img = shifted[stripes] + rng.normal(0, 32, size=(h, w, 3))
+  return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def make_dataset(root, n_images=n_images, n_classes=n_classes, size=image_size, seed=seed, verbose=True):
+  ''' write n_images synthetic images split evenly into n_classes folders of root
+
+    images already written are kept, so growing a dataset only writes the new ones
+
+    return
+      the number of images written
+  '''
+  written = 0
+  for idx in range(n_images):
+    cls = idx % n_classes
+    path = os.path.join(root, 'class%03d' % cls, '%07d.jpg' % idx)
+    if os.path.exists(path):
+      continue
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    Image.fromarray(make_image(cls, idx, size, seed)).save(path, quality=90)
+    written += 1
+    if verbose and written % 1000 == 0:
+      sys.stdout.write("\rWriting images... %d/%d" % (idx+1, n_images))
+      sys.stdout.flush()
+  if verbose and written >= 1000:
+    print()
+  # the labels file lists the images found when it was made
+  labels_file = os.path.join(root, 'labels.csv')
+  if written and os.path.exists(labels_file):
+    os.remove(labels_file)
+  return written
+
+
+class Timer(object):
+  ''' measures the wall time of a with block into seconds '''
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc):
+    self.seconds = time.time() - self.start
+
+
+def _clear_cache(extractor):
+  path = extractor.feature_cache().path
+  shutil.rmtree(path, ignore_errors=True)
+
+
+def run(root, n_images=n_images, n_classes=n_classes, size=image_size, features=features, n_queries=n_queries,
+        depth=depth, d_type=d_type, n_workers=n_workers, sweeps=True, seed=seed, verbose=True):
+  ''' generate the dataset and time the pipeline on it
+
+    caches and results are written in root, next to the images, so the benchmark never
+    touches the caches of the real databases
+
+    arguments
+      root     : working directory of the benchmark, images go to root/images
+      n_images : number of synthetic images
+      n_classes: number of classes
+      size     : (height, width) of the images
+      features : names of the features to time, see registry.extractors
+      n_queries: number of queries timed by infer
+      depth    : retrieved depth of infer and evaluate_class
+      d_type   : distance type
+      n_workers: worker processes of the extraction
+      sweeps   : time the fusion and projection sweeps, which need at least two features
+
+    return
+      a dict of the timings in seconds, see the module docstring
+  '''
+  from registry import get_extractor
+
+  image_root = os.path.join(os.path.abspath(root), 'images')
+  report = {
+    'config': {'n_images': n_images, 'n_classes': n_classes, 'image_size': list(size), 'features': list(features),
+               'n_queries': n_queries, 'depth': depth, 'd_type': d_type, 'n_workers': n_workers, 'seed': seed},
+    'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                    'platform': platform.platform(), 'cpu_count': multiprocessing.cpu_count()},
+    'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+  }
+
+  with Timer() as t:
+    written = make_dataset(image_root, n_images, n_classes, size, seed, verbose=verbose)
+  report['generate'] = {'seconds': t.seconds, 'written': written}
+
+  cwd = os.getcwd()
+  os.chdir(root)
+  try:
+    if not os.path.isdir('result'):
+      os.makedirs('result')
+    db = Database(image_root)
+    paths = list(db.get_data()['img'])
+
+    with Timer() as t:
+      for batch in iter_batches(paths):
+        pass
+    report['decode'] = {'seconds': t.seconds, 'ms_per_image': 1000. * t.seconds / max(1, len(paths))}
+
+    report['extraction'], report['cache_load'], report['infer'], report['evaluate_class'] = {}, {}, {}, {}
+    for name in features:
+      extractor = get_extractor(name)
+      _clear_cache(extractor)
+      with Timer() as t:
+        extractor.make_samples(db, verbose=False, n_workers=n_workers)
+      report['extraction'][name] = {'seconds': t.seconds, 'ms_per_image': 1000. * t.seconds / max(1, len(paths))}
+
+      with Timer() as t:
+        samples = extractor.make_samples(db, verbose=False)
+      report['cache_load'][name] = {'seconds': t.seconds}
+
+      with Timer() as t:
+        index = SampleIndex(samples)
+      build = t.seconds
+      queries = np.random.RandomState(seed).choice(len(samples), min(n_queries, len(samples)), replace=False)
+      latencies = []
+      for q in queries:
+        with Timer() as t:
+          infer(samples[q], samples=index, depth=depth, d_type=d_type)
+        latencies.append(t.seconds)
+      report['infer'][name] = {'index_seconds': build, 'mean_ms': 1000. * np.mean(latencies),
+                               'p95_ms': 1000. * np.percentile(latencies, 95)}
+
+      with Timer() as t:
+        APs = evaluate_class(db, f_instance=extractor, depth=depth, d_type=d_type)
+      report['evaluate_class'][name] = {'seconds': t.seconds,
+                                        'MMAP': float(np.mean([np.mean(aps) for aps in APs.values() if aps]))}
+
+    if sweeps and len(features) > 1:
+      import fusion, random_projection
+      with Timer() as t:
+        fusion.evaluate_sweep(db, sizes=[len(features)], feat_pools=features, d_type=d_type, depths=[None, depth])
+      report['fusion_sweep'] = {'seconds': t.seconds}
+      with Timer() as t:
+        random_projection.evaluate_sweep(db, sizes=range(1, len(features)+1), feat_pools=features,
+                                         d_type=d_type, depths=[None, depth])
+      report['projection_sweep'] = {'seconds': t.seconds}
+  finally:
+    os.chdir(cwd)
+
+  return report
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='time the CBIR pipeline on a synthetic database')
+  parser.add_argument('--root', type=str, default=os.path.join('result', 'benchmark'), help='working directory')
+  parser.add_argument('-n', '--n_images', type=int, default=n_images, help='number of images, 1k to 1M')
+  parser.add_argument('-c', '--n_classes', type=int, default=n_classes, help='number of classes')
+  parser.add_argument('--size', type=int, nargs=2, default=image_size, help='height and width of the images')
+  parser.add_argument('--features', nargs='*', default=features, help='features to time')
+  parser.add_argument('-w', '--n_workers', type=int, default=n_workers, help='extraction worker processes')
+  parser.add_argument('--no_sweeps', action='store_true', help='skip the fusion and projection sweeps')
+  parser.add_argument('-o', '--output', type=str, default=None, help='JSON report path, printed if not given')
+  args = parser.parse_args()
+
+  report = run(args.root, n_images=args.n_images, n_classes=args.n_classes, size=tuple(args.size),
+               features=args.features, n_workers=args.n_workers, sweeps=not args.no_sweeps)
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w', encoding='UTF-8') as f:
+      f.write(output)
+  print(output)
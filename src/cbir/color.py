@@ -2,18 +2,22 @@
 
 from evaluate import distance, evaluate_class
 from database import Database
+from feature_store import FeatureCache
+from extraction import extract_features, n_workers
+from precision import precisions, compute_dtype, default_precision
+from image_loader import load_image
+from integral import IntegralHistogram, lattice
 
-from six.moves import cPickle
 import numpy as np
-import itertools
 import os
-import imageio
 
 
 # configs for histogram
 n_bin   = 12        # histogram bins
 n_slice = 3         # slice image
-h_type  = 'region'  # global or region
+h_type  = 'region'  # global, region or pyramid
+levels  = (1, 2, 4)  # grids of the spatial pyramid
+image_size = None   # (height, width) JPEGs are decoded to cover at least, None for full resolution
 d_type  = 'd1'      # distance type
 
 depth   = 3         # retrieved depth, set to None will count the ap for whole database
@@ -64,7 +68,7 @@ if not os.path.exists(cache_dir):
 
 class Color(object):
 
-  def histogram(self, input, n_bin=n_bin, type=h_type, n_slice=n_slice, normalize=True):
+  def histogram(self, input, n_bin=n_bin, type=h_type, n_slice=n_slice, normalize=True, levels=levels):
     ''' count img color histogram
   
       arguments
@@ -72,19 +76,23 @@ class Color(object):
         n_bin    : number of bins for each channel
         type     : 'global' means count the histogram for whole image
                    'region' means count the histogram for regions in images, then concatanate all of them
+                   'pyramid' means concatanate the region histograms of every grid in levels
         n_slice  : work when type equals to 'region', height & width will equally sliced into N slices
         normalize: normalize output histogram
+        levels   : work when type equals to 'pyramid', number of slices of each grid
   
       return
         type == 'global'
           a numpy array with size n_bin ** channel
         type == 'region'
           a numpy array with size n_slice * n_slice * (n_bin ** channel)
+        type == 'pyramid'
+          a numpy array with size sum(n * n for n in levels) * (n_bin ** channel)
     '''
     if isinstance(input, np.ndarray):
-      img = input.copy()
+      img = input
     else:
-      img = imageio.imread(input)
+      img = load_image(input)
     
     height, width, channel = img.shape
     bins = np.linspace(0, 256, n_bin+1, endpoint=True)  # slice bins equally for each channel
@@ -93,14 +101,10 @@ class Color(object):
       hist = self._count_hist(img, n_bin, bins, channel)
   
     elif type == 'region':
-      hist = np.zeros((n_slice, n_slice, n_bin ** channel))
-      h_slice = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
-      w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
+      hist = self.integral(img, n_bin, n_slices=[n_slice]).grid(n_slice).astype(np.float64)
   
-      for hs in range(len(h_slice)-1):
-        for ws in range(len(w_slice)-1):
-          img_r = img[h_slice[hs]:h_slice[hs+1], w_slice[ws]:w_slice[ws+1]]  # slice img to regions
-          hist[hs][ws] = self._count_hist(img_r, n_bin, bins, channel)
+    elif type == 'pyramid':
+      hist = self.integral(img, n_bin, n_slices=levels).pyramid(levels).astype(np.float64)
   
     if normalize:
       hist /= np.sum(hist)
@@ -108,50 +112,133 @@ class Color(object):
     return hist.flatten()
   
   
+  def _quantize(self, input, n_bin, bins, channel):
+    ''' map every pixel to the index of its color bin
+  
+      the index packs the bin of each channel, first channel being the most significant,
+      which is the order itertools.product(range(n_bin), repeat=channel) enumerates bins
+  
+      return
+        a numpy array of shape (height, width) with values in [0, n_bin ** channel)
+    '''
+    if input.dtype == np.uint8:
+      # look-up table over the 256 possible values is cheaper than searching every pixel
+      lut = np.searchsorted(bins, np.arange(256), side='right') - 1
+      q = lut[input]
+    else:
+      q = np.searchsorted(bins, input, side='right') - 1
+    q = np.clip(q, 0, n_bin-1)
+  
+    packed = q[..., 0].astype(np.intp)
+    for c in range(1, channel):
+      packed = packed * n_bin + q[..., c]
+    return packed
+  
+  
   def _count_hist(self, input, n_bin, bins, channel):
-    img = input.copy()
-    bins_idx = {key: idx for idx, key in enumerate(itertools.product(np.arange(n_bin), repeat=channel))}  # permutation of bins
-    hist = np.zeros(n_bin ** channel)
+    packed = self._quantize(input, n_bin, bins, channel)
+    return np.bincount(packed.ravel(), minlength=n_bin ** channel).astype(np.float64)
+  
+  
+  def _count_region_hist(self, input, n_bin, bins, channel, h_slice, w_slice):
+    ''' count the histograms of all regions in a single pass
+  
+      every pixel gets the index of its region, which is combined with its color bin
+      so that one bincount fills the n_slice * n_slice histograms at once
+  
+      return
+        a numpy array with shape (len(h_slice)-1, len(w_slice)-1, n_bin ** channel)
+    '''
+    height, width, _ = input.shape
+    n_h, n_w, n_color = len(h_slice)-1, len(w_slice)-1, n_bin ** channel
+  
+    packed = self._quantize(input, n_bin, bins, channel)
+    h_region = np.searchsorted(h_slice, np.arange(height), side='right') - 1
+    w_region = np.searchsorted(w_slice, np.arange(width), side='right') - 1
+    region = h_region[:, None] * n_w + w_region[None, :]
+  
+    hist = np.bincount((region * n_color + packed).ravel(), minlength=n_h * n_w * n_color)
+    return hist.reshape(n_h, n_w, n_color)
+  
+  
+  def integral(self, input, n_bin=n_bin, n_slices=(n_slice,)):
+    ''' integral histogram of an image, from which the region histograms of any grid in n_slices,
+        or any pyramid of them, are read without going through the pixels again
   
-    # cluster every pixels
-    for idx in range(len(bins)-1):
-      img[(input >= bins[idx]) & (input < bins[idx+1])] = idx
-    # add pixels into bins
-    height, width, _ = img.shape
-    for h in range(height):
-      for w in range(width):
-        b_idx = bins_idx[tuple(img[h,w])]
-        hist[b_idx] += 1
+      arguments
+        input   : a path to a image or a numpy.ndarray
+        n_bin   : number of bins for each channel
+        n_slices: slice counts the integral histogram needs to serve
+  
+      return
+        an instance of class integral.IntegralHistogram of pixel counts
+    '''
+    img = input if isinstance(input, np.ndarray) else load_image(input)
+    height, width, channel = img.shape
+    bins = np.linspace(0, 256, n_bin+1, endpoint=True)
+    rows, cols = lattice(height, n_slices), lattice(width, n_slices)
+    return IntegralHistogram(self._count_region_hist(img, n_bin, bins, channel, rows, cols), rows, cols)
   
-    return hist
+  
+  def sweep(self, input, n_bins=(n_bin,), n_slices=(n_slice,), normalize=True):
+    ''' region histograms of an image for every (n_bin, n_slice) setting
+  
+      the image is quantized once per n_bin that doesn't divide another one of n_bins, coarser
+      bins are merged from these, every grid is then read from the integral histograms
+  
+      return
+        a dict {(n_bin, n_slice): histogram as made by histogram(type='region')}
+    '''
+    img = input if isinstance(input, np.ndarray) else load_image(input)
+    channel = img.shape[2]
+    bases = [b for b in n_bins if not any(m != b and m % b == 0 for m in n_bins)]
+    integrals = {b: self.integral(img, b, n_slices) for b in bases}
+    ret = {}
+    for b in n_bins:
+      base = [m for m in bases if m % b == 0][0]
+      integ = integrals[base] if base == b else integrals[base].rebin(base // b, channel)
+      for n in n_slices:
+        hist = integ.grid(n).astype(np.float64)
+        if normalize:
+          hist /= np.sum(hist)
+        ret[b, n] = hist.flatten()
+    return ret
   
   
-  def make_samples(self, db, verbose=True):
+  def feature_cache(self, precision=default_precision):
+    ''' FeatureCache holding the histograms of make_samples '''
     if h_type == 'global':
       sample_cache = "histogram_cache-{}-n_bin{}".format(h_type, n_bin)
     elif h_type == 'region':
       sample_cache = "histogram_cache-{}-n_bin{}-n_slice{}".format(h_type, n_bin, n_slice)
-    
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
-      if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.histogram(d_img, type=h_type, n_bin=n_bin, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
-    return samples
+    elif h_type == 'pyramid':
+      sample_cache = "histogram_cache-{}-n_bin{}-levels{}".format(h_type, n_bin, "_".join(map(str, levels)))
+    config = {'extractor': 'color', 'h_type': h_type, 'n_bin': n_bin, 'n_slice': n_slice,
+              'image_size': list(image_size) if image_size else None}
+    if h_type == 'pyramid':
+      config['levels'] = list(levels)
+    return FeatureCache(os.path.join(cache_dir, sample_cache), config=config, precision=precision)
+  
+  
+  def histogram_kwargs(self):
+    ''' arguments make_samples passes to histogram '''
+    return {'type': h_type, 'n_bin': n_bin, 'n_slice': n_slice, 'levels': levels}
+  
+  
+  def decode_size(self):
+    ''' size images are decoded at, see image_loader.load_image '''
+    return image_size
+  
+  
+  def make_samples(self, db, verbose=True, n_workers=n_workers, precision=default_precision):
+    cache = self.feature_cache(precision)
+    extract = lambda paths: extract_features(self, paths, n_workers=n_workers, verbose=verbose,
+                                             dtype=compute_dtype(precisions[precision]), image_size=image_size,
+                                             **self.histogram_kwargs())
+    message = "config=%s, distance=%s, depth=%s" % (os.path.basename(cache.path), d_type, depth)
+    store = cache.update(db, extract, verbose=verbose, message=message)
+  
+    return store.as_samples()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from evaluate import SampleIndex, sparse_distance_matrix, to_csr, _top_k
+from feature_store import FeatureStore
+from precision import compute_dtype
+from ann import ANNIndex, index_types, _kmeans
+
+from scipy import sparse
+import numpy as np
+
+
+''' Compressed indexes
+
+    the histograms are not kept, queries are scored against a compressed copy of them
+
+      PQIndex    : product quantization, every sample is stored as n_subspaces bytes and scored
+                   with asymmetric distance computation (exact query against quantized samples)
+      SparseIndex: CSR matrix of the non-zero values, scored with sparse-aware kernels
+
+    both expose the query / search / save interface of ann.ANNIndex and are loaded with
+    ann.load_index once this module is imported
+'''
+
+
+def _labels_index(index):
+  ''' SampleIndex holding only the image paths and classes of index '''
+  store = index.store
+  return SampleIndex(FeatureStore(np.empty((len(store), 0), dtype=np.float32), store.img, store.cls_id, store.classes))
+
+
+class CompressedIndex(ANNIndex):
+  ''' base class of compressed indexes, subclasses implement _compress and _distances '''
+
+  def build(self, samples):
+    index = samples if isinstance(samples, SampleIndex) else SampleIndex(samples)
+    self._compress(index.hist)
+    self.index = _labels_index(index)
+    return self
+
+  def _compress(self, hist):
+    raise NotImplementedError("Needs to implemented this method")
+
+  def _distances(self, q_hist, d_type):
+    raise NotImplementedError("Needs to implemented this method")
+
+  def _candidates(self, q_hist):
+    # every sample is scored
+    return np.arange(len(self.index))
+
+  def search(self, q_hist, q_img=None, depth=None, d_type=None):
+    dis = self._distances(np.asarray(q_hist, dtype=np.float32), d_type or self.d_type)
+    rows = np.arange(len(dis))
+    if q_img is not None:
+      rows = rows[self.index.img != q_img]
+    k = min(depth, len(rows)) if depth else len(rows)
+    top = rows[_top_k(dis[rows], k)]
+    return top, dis[top]
+
+  @property
+  def nbytes(self):
+    ''' memory used by the compressed histograms '''
+    return sum(getattr(self, name).nbytes for name in self.arrays)
+
+
+class PQIndex(CompressedIndex):
+  ''' product quantization index
+
+    dimensions are split into n_subspaces contiguous blocks, each block of a sample is replaced
+    by the id of its closest centroid among n_centroids learnt by k-means on that block
+
+    arguments
+      n_subspaces: number of blocks, i.e. bytes per sample
+      n_centroids: centroids per block, at most 256 so that codes fit in a byte
+      n_train    : number of samples used to train the codebooks
+      n_iter     : k-means iterations
+  '''
+
+  arrays = ('codebooks', 'codes', 'sq_norms')
+  params = ('n_subspaces', 'n_centroids', 'n_train', 'n_iter')
+
+  def __init__(self, n_subspaces=64, n_centroids=256, n_train=20000, n_iter=20, d_type='d1', seed=0):
+    super(PQIndex, self).__init__(d_type=d_type, seed=seed)
+    assert n_centroids <= 256, "codes are stored as bytes, n_centroids can't exceed 256!"
+    self.n_subspaces = n_subspaces
+    self.n_centroids = n_centroids
+    self.n_train     = n_train
+    self.n_iter      = n_iter
+
+  def _split(self, hist):
+    ''' view hist as (n, n_subspaces, sub_dims), padding dims with zeros to a multiple of n_subspaces '''
+    hist = np.atleast_2d(hist)
+    sub_dims = -(-hist.shape[1] // self.n_subspaces)
+    pad = sub_dims * self.n_subspaces - hist.shape[1]
+    if pad:
+      hist = np.hstack([hist, np.zeros((len(hist), pad), dtype=hist.dtype)])
+    return hist.reshape(len(hist), self.n_subspaces, sub_dims)
+
+  def _compress(self, hist):
+    rng = np.random.RandomState(self.seed)
+    train = np.sort(rng.choice(len(hist), min(self.n_train, len(hist)), replace=False))
+    train = self._split(np.asarray(hist[train], dtype=np.float32))
+    k = min(self.n_centroids, len(train))
+    self.codebooks = np.stack([_kmeans(train[:, m], k, n_iter=self.n_iter, seed=self.seed+m)[0]
+                               for m in range(self.n_subspaces)])
+
+    self.codes = np.empty((len(hist), self.n_subspaces), dtype=np.uint8)
+    self.sq_norms = np.empty(len(hist), dtype=np.float32)
+    cb_sq_norms = np.einsum('mkd,mkd->mk', self.codebooks, self.codebooks)
+    for start in range(0, len(hist), 4096):
+      block = self._split(np.asarray(hist[start:start+4096], dtype=np.float32))
+      for m in range(self.n_subspaces):
+        dis = cb_sq_norms[m][None, :] - 2 * np.dot(block[:, m], self.codebooks[m].T)
+        self.codes[start:start+len(block), m] = np.argmin(dis, axis=1)
+      # squared norms of the reconstructed samples, used by d2 and cosine
+      self.sq_norms[start:start+len(block)] = cb_sq_norms[np.arange(self.n_subspaces), self.codes[start:start+len(block)]].sum(axis=1)
+
+  def _distances(self, q_hist, d_type):
+    q = self._split(q_hist)[0]
+    # distance, or dot product, between the query block and every centroid of each block
+    if d_type == 'd1':
+      table = np.absolute(q[:, None, :] - self.codebooks).sum(axis=2)
+    elif d_type in ('d2', 'square'):
+      table = ((q[:, None, :] - self.codebooks) ** 2).sum(axis=2)
+    elif d_type in ('d2-norm', 'd7', 'd8', 'cosine'):
+      table = np.einsum('md,mkd->mk', q, self.codebooks)
+    else:
+      raise ValueError("distance type %s isn't supported by PQIndex" % d_type)
+
+    dis = np.empty(len(self.codes), dtype=np.float32)
+    subspaces = np.arange(self.n_subspaces)
+    for start in range(0, len(self.codes), 65536):
+      dis[start:start+65536] = table[subspaces, self.codes[start:start+65536]].sum(axis=1)
+
+    if d_type in ('d2-norm', 'd7', 'd8'):
+      return 2 - 2 * dis
+    elif d_type == 'cosine':
+      return 1 - dis / (np.sqrt(np.dot(q_hist, q_hist)) * np.sqrt(self.sq_norms))
+    return dis
+
+
+class SparseIndex(CompressedIndex):
+  ''' index keeping only the non-zero values of the histograms, as a CSR matrix
+
+    region color histograms are mostly zeros, so the matrix is many times smaller than the
+    dense one and the sparse kernels of evaluate.sparse_distance_matrix only visit non-zeros
+  '''
+
+  arrays = ('data', 'indices', 'indptr', 'sq_norms')
+  params = ('n_dims',)
+
+  def __init__(self, n_dims=None, d_type='d1', seed=0):
+    super(SparseIndex, self).__init__(d_type=d_type, seed=seed)
+    self.n_dims = n_dims
+
+  def _compress(self, hist):
+    matrix = to_csr(hist, dtype=compute_dtype(hist.dtype))
+    self.n_dims   = hist.shape[1]
+    self.data     = matrix.data
+    self.indices  = matrix.indices
+    self.indptr   = matrix.indptr
+    self.sq_norms = np.asarray(matrix.multiply(matrix).sum(axis=1), dtype=np.float32).ravel()
+    self._matrix  = matrix
+
+  @property
+  def matrix(self):
+    if getattr(self, '_matrix', None) is None:
+      self._matrix = sparse.csr_matrix((self.data, self.indices, self.indptr), shape=(len(self.indptr)-1, self.n_dims))
+    return self._matrix
+
+  @property
+  def density(self):
+    return self.matrix.nnz / float(max(1, self.matrix.shape[0] * self.matrix.shape[1]))
+
+  def _distances(self, q_hist, d_type):
+    return sparse_distance_matrix(q_hist, self.matrix, d_type=d_type, sq_norms=self.sq_norms)[0]
+
+
+index_types.update({cls.__name__: cls for cls in (PQIndex, SparseIndex)})
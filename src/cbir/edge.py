@@ -4,17 +4,22 @@ from __future__ import print_function
 
 from evaluate import evaluate_class
 from database import Database
+from feature_store import FeatureCache
+from extraction import extract_features, n_workers
+from precision import precisions, compute_dtype, default_precision
+from image_loader import load_image
+from integral import IntegralMap
 
-from six.moves import cPickle
 import numpy as np
-import scipy.misc
 from math import sqrt
 import os
 
 
-stride = (1, 1)
+stride = (2, 2)  # the stride Edge features have always been extracted with, see the stride exps below
 n_slice  = 10
 h_type   = 'region'
+levels   = (1, 2, 4)  # grids of the spatial pyramid
+image_size = None  # (height, width) JPEGs are decoded to cover at least, None for full resolution
 d_type   = 'cosine'
 
 depth    = 5
@@ -84,7 +89,7 @@ if not os.path.exists(cache_dir):
 
 class Edge(object):
 
-  def histogram(self, input, stride=(2, 2), type=h_type, n_slice=n_slice, normalize=True):
+  def histogram(self, input, stride=(2, 2), type=h_type, n_slice=n_slice, normalize=True, levels=levels):
     ''' count img histogram
   
       arguments
@@ -92,33 +97,35 @@ class Edge(object):
         stride   : stride of edge kernel
         type     : 'global' means count the histogram for whole image
                    'region' means count the histogram for regions in images, then concatanate all of them
+                   'pyramid' means concatanate the region histograms of every grid in levels
         n_slice  : work when type equals to 'region', height & width will equally sliced into N slices
         normalize: normalize output histogram
+        levels   : work when type equals to 'pyramid', number of slices of each grid
   
       return
         type == 'global'
           a numpy array with size len(edge_kernels)
         type == 'region'
           a numpy array with size len(edge_kernels) * n_slice * n_slice
+        type == 'pyramid'
+          a numpy array with size len(edge_kernels) * sum(n * n for n in levels)
     '''
     if isinstance(input, np.ndarray):  # examinate input type
-      img = input.copy()
+      img = input
     else:
-      img = scipy.misc.imread(input, mode='RGB')
+      img = load_image(input)
     height, width, channel = img.shape
   
     if type == 'global':
       hist = self._conv(img, stride=stride, kernels=edge_kernels)
   
     elif type == 'region':
-      hist = np.zeros((n_slice, n_slice, edge_kernels.shape[0]))
-      h_silce = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
-      w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
+      # filter the whole image once, every region is then read from its summed-area tables
+      hist = self._normalize_regions(self.integral(img, stride).grid(n_slice))
   
-      for hs in range(len(h_silce)-1):
-        for ws in range(len(w_slice)-1):
-          img_r = img[h_silce[hs]:h_silce[hs+1], w_slice[ws]:w_slice[ws+1]]  # slice img to regions
-          hist[hs][ws] = self._conv(img_r, stride=stride, kernels=edge_kernels)
+    elif type == 'pyramid':
+      integ = self.integral(img, stride)
+      hist = np.concatenate([self._normalize_regions(integ.grid(n)).ravel() for n in levels])
   
     if normalize:
       hist /= np.sum(hist)
@@ -126,28 +133,98 @@ class Edge(object):
     return hist.flatten()
   
   
+  def _normalize_regions(self, hist):
+    ''' normalize the histogram of every region, as _pool does '''
+    return hist / np.sum(hist, axis=-1, keepdims=True)
+  
+  
+  def integral(self, input, stride=(2, 2)):
+    ''' summed-area tables of the edge responses of an image, from which the region histograms
+        of any grid are read without filtering the image again
+  
+      arguments
+        input : a path to a image or a numpy.ndarray
+        stride: stride of edge kernel
+  
+      return
+        an instance of class integral.IntegralMap
+    '''
+    img = input if isinstance(input, np.ndarray) else load_image(input)
+    return IntegralMap(self._filter(img, kernels=edge_kernels), stride, edge_kernels.shape[1:])
+  
+  
+  def sweep(self, input, strides=((2, 2),), n_slices=(n_slice,), normalize=True):
+    ''' region histograms of an image for every (stride, n_slice) setting
+  
+      the image is filtered once, then one integral map is made per stride
+  
+      return
+        a dict {(stride, n_slice): histogram as made by histogram(type='region')}
+    '''
+    img = input if isinstance(input, np.ndarray) else load_image(input)
+    response = self._filter(img, kernels=edge_kernels)
+    ret = {}
+    for stride in strides:
+      integ = IntegralMap(response, stride, edge_kernels.shape[1:])
+      for n in n_slices:
+        hist = self._normalize_regions(integ.grid(n))
+        if normalize:
+          hist /= np.sum(hist)
+        ret[tuple(stride), n] = hist.flatten()
+    return ret
+  
+  
   def _conv(self, img, stride, kernels, normalize=True):
     H, W, C = img.shape
-    conv_kernels = np.expand_dims(kernels, axis=3)
-    conv_kernels = np.tile(conv_kernels, (1, 1, 1, C))
-    assert list(conv_kernels.shape) == list(kernels.shape) + [C]  # check kernels size
+    response = self._filter(img, kernels)
+    return self._pool(response, (0, H), (0, W), stride=stride, kernel_size=kernels.shape[1:], normalize=normalize)
   
-    sh, sw = stride
-    kn, kh, kw, kc = conv_kernels.shape
   
-    hh = int((H - kh) / sh + 1)
-    ww = int((W - kw) / sw + 1)
+  def _filter(self, img, kernels):
+    ''' correlate every kernel with the image at stride 1
   
-    hist = np.zeros(kn)
+      kernels are applied identically on every channel, so the channels are summed
+      first and each kernel becomes a weighted sum of kh * kw shifted copies of the image
   
-    for idx, k in enumerate(conv_kernels):
-      for h in range(hh):
-        hs = int(h*sh)
-        he = int(h*sh + kh)
-        for w in range(ww):
-          ws = w*sw
-          we = w*sw + kw
-          hist[idx] += np.sum(img[hs:he, ws:we] * k)  # element-wise product
+      return
+        a numpy array with size kn * (H - kh + 1) * (W - kw + 1)
+    '''
+    H, W, C = img.shape
+    kn, kh, kw = kernels.shape
+    hh, ww = H - kh + 1, W - kw + 1
+    if hh <= 0 or ww <= 0:
+      return np.zeros((kn, max(hh, 0), max(ww, 0)))
+  
+    flat = img.sum(axis=2, dtype=np.float64)
+    response = np.zeros((kn, hh, ww))
+    for i in range(kh):
+      for j in range(kw):
+        response += kernels[:, i, j, None, None] * flat[None, i:i+hh, j:j+ww]
+  
+    return response
+  
+  
+  def _pool(self, response, h_range, w_range, stride, kernel_size, normalize=True):
+    ''' sum the kernel responses of the strided positions lying inside a region
+  
+      arguments
+        response   : output of _filter
+        h_range    : (start, end) rows of the region in the image
+        w_range    : (start, end) columns of the region in the image
+        stride     : stride of edge kernel, positions start at the top left corner of the region
+        kernel_size: (kh, kw) size of edge kernel
+  
+      return
+        a numpy array with size len(edge_kernels)
+    '''
+    (hs, he), (ws, we) = h_range, w_range
+    sh, sw = stride
+    kh, kw = kernel_size
+  
+    hh = max(int((he - hs - kh) / sh + 1), 0)
+    ww = max(int((we - ws - kw) / sw + 1), 0)
+  
+    hist = response[:, hs:hs+hh*sh:sh, ws:ws+ww*sw:sw].sum(axis=(1, 2))
   
     if normalize:
       hist /= np.sum(hist)
@@ -155,35 +232,40 @@ class Edge(object):
     return hist
   
   
-  def make_samples(self, db, verbose=True):
+  def feature_cache(self, precision=default_precision):
+    ''' FeatureCache holding the histograms of make_samples '''
     if h_type == 'global':
       sample_cache = "edge-{}-stride{}".format(h_type, stride)
     elif h_type == 'region':
       sample_cache = "edge-{}-stride{}-n_slice{}".format(h_type, stride, n_slice)
+    elif h_type == 'pyramid':
+      sample_cache = "edge-{}-stride{}-levels{}".format(h_type, stride, "_".join(map(str, levels)))
+    config = {'extractor': 'edge', 'h_type': h_type, 'stride': list(stride), 'n_slice': n_slice,
+              'image_size': list(image_size) if image_size else None}
+    if h_type == 'pyramid':
+      config['levels'] = list(levels)
+    return FeatureCache(os.path.join(cache_dir, sample_cache), config=config, precision=precision)
+  
+  
+  def histogram_kwargs(self):
+    ''' arguments make_samples passes to histogram '''
+    return {'type': h_type, 'stride': stride, 'n_slice': n_slice, 'levels': levels}
+  
+  
+  def decode_size(self):
+    ''' size images are decoded at, see image_loader.load_image '''
+    return image_size
+  
+  
+  def make_samples(self, db, verbose=True, n_workers=n_workers, precision=default_precision):
+    cache = self.feature_cache(precision)
+    extract = lambda paths: extract_features(self, paths, n_workers=n_workers, verbose=verbose,
+                                             dtype=compute_dtype(precisions[precision]), image_size=image_size,
+                                             **self.histogram_kwargs())
+    message = "config=%s, distance=%s, depth=%s" % (os.path.basename(cache.path), d_type, depth)
+    store = cache.update(db, extract, verbose=verbose, message=message)
   
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
-      if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-  
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.histogram(d_img, type=h_type, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
-    return samples
+    return store.as_samples()
 
 
 if __name__ == "__main__":
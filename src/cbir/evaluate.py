@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from scipy import spatial
+from feature_store import FeatureStore
+from precision import compute_dtype
+
+from scipy import spatial, sparse
 import numpy as np
 
 
@@ -11,6 +14,24 @@ class Evaluation(object):
 
 
 def distance(v1, v2, d_type='d1'):
+  ''' distance between two histograms
+
+    v1 and v2 are dense vectors, rows of a scipy sparse matrix or (indices, values) pairs of their
+    non-zero entries, sparse inputs are compared on their non-zero entries only
+
+    distance types
+      d1     : L1
+      d2     : squared L2, same as square
+      d2-norm: squared L2 of unit vectors, same as d7 and d8
+      d3     : Chebyshev, largest absolute difference
+      d4     : histogram intersection, 1 - sum of the minimums over the larger mass
+      d5     : chi-square
+      d6     : Hellinger
+      cosine : cosine distance
+  '''
+  if isinstance(v1, tuple) or isinstance(v2, tuple) or sparse.issparse(v1) or sparse.issparse(v2):
+    return _sparse_distance(v1, v2, d_type=d_type)
+
   assert v1.shape == v2.shape, "shape of two vectors need to be same!"
 
   if d_type == 'd1':
@@ -20,13 +41,15 @@ def distance(v1, v2, d_type='d1'):
   elif d_type == 'd2-norm':
     return 2 - 2 * np.dot(v1, v2)
   elif d_type == 'd3':
-    pass
+    return np.max(np.absolute(v1 - v2))
   elif d_type == 'd4':
-    pass
+    return 1 - np.sum(np.minimum(v1, v2)) / _mass(np.sum(v1), np.sum(v2))
   elif d_type == 'd5':
-    pass
+    s = v1 + v2
+    nz = s != 0
+    return np.sum((v1 - v2)[nz] ** 2 / s[nz])
   elif d_type == 'd6':
-    pass
+    return np.sqrt(0.5 * np.sum((np.sqrt(v1) - np.sqrt(v2)) ** 2))
   elif d_type == 'd7':
     return 2 - 2 * np.dot(v1, v2)
   elif d_type == 'd8':
@@ -35,6 +58,380 @@ def distance(v1, v2, d_type='d1'):
     return spatial.distance.cosine(v1, v2)
   elif d_type == 'square':
     return np.sum((v1 - v2) ** 2)
+  raise ValueError("distance type %s isn't supported" % d_type)
+
+
+def _mass(s1, s2):
+  ''' denominator of the histogram intersection, guarded against empty histograms '''
+  return np.maximum(np.maximum(s1, s2), np.finfo(np.float32).tiny)
+
+
+def _nonzeros(v):
+  ''' (indices, values) of the non-zero entries of a dense vector, a sparse row or such a pair '''
+  if isinstance(v, tuple):
+    return np.asarray(v[0], dtype=np.intp), np.asarray(v[1])
+  if sparse.issparse(v):
+    v = sparse.csr_matrix(v)
+    v.sum_duplicates()
+    return v.indices.astype(np.intp), v.data
+  v = np.ravel(v)
+  idx = np.flatnonzero(v)
+  return idx, v[idx]
+
+
+def _sparse_distance(v1, v2, d_type='d1'):
+  ''' distance of two vectors computed from their non-zero entries '''
+  i1, x1 = _nonzeros(v1)
+  i2, x2 = _nonzeros(v2)
+  _, c1, c2 = np.intersect1d(i1, i2, assume_unique=True, return_indices=True)
+  a, b = x1[c1], x2[c2]  # values of the entries non-zero in both
+  dot = np.dot(a, b)
+
+  if d_type == 'd1':
+    return np.sum(np.absolute(x1)) + np.sum(np.absolute(x2)) - np.sum(np.absolute(a) + np.absolute(b) - np.absolute(a - b))
+  elif d_type in ('d2', 'square'):
+    return max(np.dot(x1, x1) + np.dot(x2, x2) - 2 * dot, 0)
+  elif d_type in ('d2-norm', 'd7', 'd8'):
+    return 2 - 2 * dot
+  elif d_type == 'cosine':
+    return 1 - dot / (np.sqrt(np.dot(x1, x1)) * np.sqrt(np.dot(x2, x2)))
+
+  only1 = np.ones(len(i1), dtype=bool)
+  only1[c1] = False
+  only2 = np.ones(len(i2), dtype=bool)
+  only2[c2] = False
+  if d_type == 'd3':
+    diffs = [np.absolute(a - b), np.absolute(x1[only1]), np.absolute(x2[only2])]
+    return max([np.max(d) for d in diffs if len(d)] or [0])
+  elif d_type == 'd4':
+    return 1 - np.sum(np.minimum(a, b)) / _mass(np.sum(x1), np.sum(x2))
+  elif d_type == 'd5':
+    # an entry non-zero in a single vector adds (x - 0)^2 / x = x
+    s = a + b
+    nz = s != 0
+    return np.sum(x1[only1]) + np.sum(x2[only2]) + np.sum((a - b)[nz] ** 2 / s[nz])
+  elif d_type == 'd6':
+    return np.sqrt(max(0.5 * (np.sum(x1) + np.sum(x2) - 2 * np.sum(np.sqrt(a * b))), 0))
+  raise ValueError("distance type %s isn't supported" % d_type)
+
+
+class SampleIndex(object):
+  ''' dense view of samples, built once and shared by every query
+
+    arguments
+      samples: a list of {
+                           'img': <path_to_img>,
+                           'cls': <img class>,
+                           'hist' <img histogram>
+                         }
+               samples made from a FeatureStore reuse its matrix without copy, whatever its precision
+      dtype  : storage type of the stacked histograms, None keeps the one of the samples store
+      sparse : whether distances may be computed on a CSR copy of the histograms, building it
+               only pays off for indexes queried many times
+  '''
+
+  def __init__(self, samples, dtype=None, sparse=True):
+    store = FeatureStore.from_samples(samples, dtype=dtype)
+    self.samples = samples
+    self.store   = store
+    self.img     = store.img
+    self.cls     = store.cls
+    self.hist    = store.hist  # a view of the store matrix, memory-mapped for a loaded store
+    self.dtype   = compute_dtype(store.hist.dtype)  # type distances are computed with
+    self.sparse  = sparse
+    self._sq_norms = None
+    self._img_id   = None
+    self._cls_id   = None
+    self._density  = None
+    self._csr      = None
+
+  def __len__(self):
+    return len(self.hist)
+
+  @classmethod
+  def of(cls, samples):
+    ''' SampleIndex of samples, kept on them so that later queries reuse it
+
+      samples made from a FeatureStore, and stores, hold their index; a plain list of samples
+      gets a new index on every call, which is then only used densely
+    '''
+    if isinstance(samples, SampleIndex):
+      return samples
+    index = getattr(samples, 'sample_index', None)
+    if index is not None and len(index) == len(samples):
+      return index
+    if not hasattr(samples, 'store') and not isinstance(samples, FeatureStore):
+      return cls(samples, sparse=False)
+    index = cls(samples)
+    samples.sample_index = index
+    return index
+
+  @property
+  def img_id(self):
+    ''' integer id of each sample image, equal ids mean the same image '''
+    if self._img_id is None:
+      self._img_id = _factorize(self.img)
+    return self._img_id
+
+  @property
+  def cls_id(self):
+    ''' integer id of each sample class '''
+    if self._cls_id is None:
+      self._cls_id = _factorize(self.cls)
+    return self._cls_id
+
+  @property
+  def native(self):
+    ''' whether the histograms are stored with the type distances are computed with '''
+    return isinstance(self.hist, np.ndarray) and self.hist.dtype == self.dtype
+
+  def blocks(self, block_rows=4096):
+    ''' (start, histograms of the rows from start) by blocks of rows, decoded to self.dtype '''
+    for start in range(0, len(self.hist), block_rows):
+      yield start, np.asarray(self.hist[start:start+block_rows], dtype=self.dtype)
+
+  @property
+  def sq_norms(self):
+    if self._sq_norms is None:
+      if self.native:
+        self._sq_norms = np.einsum('ij,ij->i', self.hist, self.hist)
+      else:
+        self._sq_norms = np.empty(len(self.hist), dtype=self.dtype)
+        for start, block in self.blocks():
+          self._sq_norms[start:start+len(block)] = np.einsum('ij,ij->i', block, block)
+    return self._sq_norms
+
+  @property
+  def density(self):
+    ''' fraction of non-zero values, measured on up to density_rows evenly spaced samples '''
+    if self._density is None:
+      rows = np.unique(np.linspace(0, len(self.hist)-1, min(len(self.hist), density_rows)).astype(np.intp))
+      sample = self.hist[rows]
+      self._density = np.count_nonzero(sample) / float(max(1, sample.size))
+    return self._density
+
+  @property
+  def csr(self):
+    ''' the histograms as a scipy CSR matrix, built on first use '''
+    if self._csr is None:
+      self._csr = to_csr(self.hist, dtype=self.dtype)
+    return self._csr
+
+
+def _factorize(values):
+  ids = {}
+  return np.array([ids.setdefault(v, len(ids)) for v in values], dtype=np.intp)
+
+
+# bytes allowed for the temporary (queries, samples, dims) block of element-wise distances
+block_bytes = 1 << 27
+# samples inspected to measure the density of an index
+density_rows = 1000
+# densities under which distances are computed on the non-zero values only, for metrics
+# summed element by element and for metrics made of dot products, which dense BLAS runs faster
+sparse_density     = 0.3
+sparse_dot_density = 0.1
+
+# metrics sparse_distance_matrix can compute
+elementwise_metrics = ('d1', 'd4', 'd5', 'd6')
+dot_metrics         = ('d2', 'square', 'd2-norm', 'd7', 'd8', 'cosine')
+
+
+def to_csr(hist, block_rows=4096, dtype=None):
+  ''' scipy CSR matrix of a dense, possibly memory-mapped, matrix, converted by blocks of rows '''
+  dtype = dtype or hist.dtype
+  blocks = [sparse.csr_matrix(np.asarray(hist[start:start+block_rows], dtype=dtype))
+            for start in range(0, len(hist), block_rows)]
+  if not blocks:
+    return sparse.csr_matrix(hist.shape, dtype=dtype)
+  return sparse.vstack(blocks, format='csr')
+
+
+def use_sparse(index, d_type):
+  ''' whether distances to the index are faster to compute on its non-zero values '''
+  if not index.sparse:
+    return False
+  if d_type in elementwise_metrics:
+    return index.density < sparse_density
+  elif d_type in dot_metrics:
+    return index.density < sparse_dot_density
+  return False
+
+
+def _elementwise(Q, X, d_type):
+  ''' (len(Q), len(X)) distances of a metric summed element by element '''
+  if d_type == 'd1':
+    return np.absolute(Q[:, None, :] - X[None, :, :]).sum(axis=2)
+  elif d_type == 'd3':
+    return np.absolute(Q[:, None, :] - X[None, :, :]).max(axis=2)
+  elif d_type == 'd4':
+    inter = np.minimum(Q[:, None, :], X[None, :, :]).sum(axis=2)
+    return 1 - inter / _mass(Q.sum(axis=1)[:, None], X.sum(axis=1)[None, :])
+  elif d_type == 'd5':
+    s = Q[:, None, :] + X[None, :, :]
+    d = (Q[:, None, :] - X[None, :, :]) ** 2
+    return np.divide(d, s, out=np.zeros_like(d), where=s != 0).sum(axis=2)
+  elif d_type == 'd6':
+    d = (np.sqrt(Q)[:, None, :] - np.sqrt(X)[None, :, :]) ** 2
+    return np.sqrt(0.5 * d.sum(axis=2))
+
+
+def distance_matrix(queries, index, d_type='d1'):
+  ''' distances between every query and every sample of the index
+
+    indexes sparser than sparse_density (sparse_dot_density for dot product metrics) are
+    scored with sparse_distance_matrix, other ones with dense kernels, by blocks of decoded
+    rows when the index is stored with less precision than it is computed with
+
+    arguments
+      queries: a numpy array with shape (n_queries, dims)
+      index  : an instance of class SampleIndex
+      d_type : distance type
+
+    return
+      a numpy array with shape (n_queries, len(index))
+  '''
+  X = index.hist
+  Q = np.atleast_2d(np.asarray(queries, dtype=index.dtype))
+  assert Q.shape[1] == X.shape[1], "shape of two vectors need to be same!"
+
+  if use_sparse(index, d_type):
+    return sparse_distance_matrix(Q, index.csr, d_type=d_type, sq_norms=index.sq_norms)
+  if index.native:
+    return _dense_distances(Q, X, index.sq_norms, d_type)
+
+  dis = np.empty((Q.shape[0], X.shape[0]), dtype=index.dtype)
+  sq_norms = index.sq_norms
+  for start, block in index.blocks():
+    dis[:, start:start+len(block)] = _dense_distances(Q, block, sq_norms[start:start+len(block)], d_type)
+  return dis
+
+
+def distance_rows(queries, index, rows, d_type='d1'):
+  ''' distances between every query and the samples of the index at rows, e.g. the candidates
+      of an approximate index, read straight from its matrix without building a new index
+
+    the rows of the CSR matrix are sliced when the index has built one and is sparse enough,
+    otherwise the rows are gathered from the dense matrix
+
+    return
+      a numpy array with shape (n_queries, len(rows))
+  '''
+  rows = np.asarray(rows, dtype=np.intp)
+  Q = np.atleast_2d(np.asarray(queries, dtype=index.dtype))
+  assert Q.shape[1] == index.hist.shape[1], "shape of two vectors need to be same!"
+  if index._csr is not None and use_sparse(index, d_type):
+    return sparse_distance_matrix(Q, index.csr[rows], d_type=d_type, sq_norms=index.sq_norms[rows])
+  X = np.asarray(index.hist[rows], dtype=index.dtype)
+  sq_norms = index._sq_norms[rows] if index._sq_norms is not None else np.einsum('ij,ij->i', X, X)
+  return _dense_distances(Q, X, sq_norms, d_type)
+
+
+def _dense_distances(Q, X, sq_norms, d_type):
+  ''' distances between the rows of Q and X, two matrices of the same type '''
+  if d_type in ('d1', 'd3', 'd4', 'd5', 'd6'):
+    # element-wise metric, processed by chunks of samples to bound memory
+    dis = np.empty((Q.shape[0], X.shape[0]), dtype=X.dtype)
+    step = max(1, block_bytes // max(1, Q.shape[0] * X.shape[1] * X.itemsize))
+    for start in range(0, X.shape[0], step):
+      dis[:, start:start+step] = _elementwise(Q, X[start:start+step], d_type)
+    return dis
+  elif d_type in ('d2', 'square'):
+    dis = np.einsum('ij,ij->i', Q, Q)[:, None] + sq_norms[None, :] - 2 * np.dot(Q, X.T)
+    return np.maximum(dis, 0, out=dis)
+  elif d_type in ('d2-norm', 'd7', 'd8'):
+    return 2 - 2 * np.dot(Q, X.T)
+  elif d_type == 'cosine':
+    norms = np.sqrt(np.einsum('ij,ij->i', Q, Q))[:, None] * np.sqrt(sq_norms)[None, :]
+    return 1 - np.dot(Q, X.T) / norms
+  raise ValueError("distance type %s can't be computed on a matrix" % d_type)
+
+
+def _row_sums(X, values):
+  ''' sum of values, laid out like X.data, over each row of the CSR matrix X '''
+  return np.asarray(sparse.csr_matrix((values, X.indices, X.indptr), shape=X.shape).sum(axis=1)).ravel()
+
+
+def sparse_distance_matrix(queries, X, d_type='d1', sq_norms=None):
+  ''' distances between dense queries and the rows of a scipy CSR matrix
+
+    only the non-zero values of X are visited, so the cost follows its density
+
+    arguments
+      queries : a numpy array with shape (n_queries, dims)
+      X       : a scipy.sparse.csr_matrix with shape (n_samples, dims)
+      d_type  : distance type, any of elementwise_metrics or dot_metrics
+      sq_norms: squared norms of the rows of X, computed if None
+
+    return
+      a numpy array with shape (n_queries, n_samples)
+  '''
+  Q = np.atleast_2d(np.asarray(queries, dtype=X.dtype))
+  assert Q.shape[1] == X.shape[1], "shape of two vectors need to be same!"
+
+  if d_type in elementwise_metrics:
+    # each sum over all dims is rewritten as a sum over the query plus a correction on the
+    # non-zero values of X, e.g. |x - q|_1 = |q|_1 + sum over non-zero x_i of (|x_i - q_i| - |q_i|)
+    dis = np.empty((Q.shape[0], X.shape[0]), dtype=X.dtype)
+    x = X.data
+    if d_type != 'd1':
+      # these corrections cancel out for close histograms, they are accumulated in float64
+      x = x.astype(np.float64)
+      x_sums = _row_sums(X, x)
+    for i, q in enumerate(Q.astype(x.dtype)):
+      q_nz = q[X.indices]
+      if d_type == 'd1':
+        dis[i] = _row_sums(X, np.absolute(x - q_nz) - np.absolute(q_nz)) + np.sum(np.absolute(q))
+      elif d_type == 'd4':
+        dis[i] = 1 - _row_sums(X, np.minimum(x, q_nz)) / _mass(np.sum(q), x_sums)
+      elif d_type == 'd5':
+        s = x + q_nz
+        chi = np.divide((x - q_nz) ** 2, s, out=np.zeros_like(s), where=s != 0)
+        dis[i] = np.sum(q) + x_sums + _row_sums(X, chi - s)
+      elif d_type == 'd6':
+        dis[i] = np.sqrt(np.maximum(0.5 * (np.sum(q) + x_sums - 2 * _row_sums(X, np.sqrt(x * q_nz))), 0))
+    return dis
+
+  dots = np.asarray(X.dot(Q.T)).T
+  if d_type in ('d2', 'square', 'cosine') and sq_norms is None:
+    sq_norms = np.asarray(X.multiply(X).sum(axis=1)).ravel()
+  if d_type in ('d2', 'square'):
+    dis = np.einsum('ij,ij->i', Q, Q)[:, None] + sq_norms[None, :] - 2 * dots
+    return np.maximum(dis, 0, out=dis)
+  elif d_type in ('d2-norm', 'd7', 'd8'):
+    return 2 - 2 * dots
+  elif d_type == 'cosine':
+    return 1 - dots / (np.sqrt(np.einsum('ij,ij->i', Q, Q))[:, None] * np.sqrt(sq_norms)[None, :])
+  raise ValueError("distance type %s can't be computed on a sparse matrix" % d_type)
+
+
+def _top_k(dis, k):
+  ''' indices of the k smallest distances, sorted like a stable sort of dis would '''
+  if k < len(dis):
+    kth = np.partition(dis, k-1)[k-1]
+    if np.isnan(kth):
+      # undefined distances sort last, they fill the places the defined ones leave
+      less, equal = np.flatnonzero(~np.isnan(dis)), np.flatnonzero(np.isnan(dis))
+    else:
+      less, equal = np.flatnonzero(dis < kth), np.flatnonzero(dis == kth)
+    equal = equal[:k-len(less)]
+    top = np.concatenate([less, equal])
+  else:
+    top = np.arange(len(dis))
+  return top[np.lexsort((top, dis[top]))]
+
+
+def _top_k_rows(dis, k):
+  ''' _top_k of every row of dis: indices of the k smallest distances, ties broken by index '''
+  kth = np.partition(dis, k-1, axis=1)[:, k-1:k]
+  less = dis < kth
+  # the k-th distance may be shared, its lowest indices fill the remaining places
+  n_equal = k - np.count_nonzero(less, axis=1)
+  equal = dis == kth
+  keep = less | (equal & (np.cumsum(equal, axis=1) <= n_equal[:, None]))
+  top = np.nonzero(keep)[1].reshape(len(dis), k)
+  order = np.lexsort((top, np.take_along_axis(dis, top, axis=1)), axis=1)
+  return np.take_along_axis(top, order, axis=1)
 
 
 def AP(label, results, sort=True):
@@ -65,6 +462,16 @@ def AP(label, results, sort=True):
   return sum_precision / hits
 
 
+def _average_precision(hits):
+  ''' same as AP, from a boolean array telling which ranked results match the query '''
+  hits = np.asarray(hits, dtype=bool)
+  n_hits = np.count_nonzero(hits)
+  if n_hits == 0:
+    return 0.
+  precision = np.cumsum(hits)[hits] / (np.flatnonzero(hits) + 1.)
+  return np.sum(precision) / n_hits
+
+
 def infer(query, samples=None, db=None, sample_db_fn=None, depth=None, d_type='d1'):
   ''' infer a query, return it's ap
 
@@ -80,33 +487,95 @@ def infer(query, samples=None, db=None, sample_db_fn=None, depth=None, d_type='d
                                 'cls': <img class>,
                                 'hist' <img histogram>
                               }
+                    or an instance of class SampleIndex; samples made by make_samples keep the index
+                    built by the first query, a plain list is indexed again on every call
       db          : an instance of class Database
       sample_db_fn: a function making samples, should be given if Database != None
       depth       : retrieved depth during inference, the default depth is equal to database size
       d_type      : distance type
   '''
-  assert samples != None or (db != None and sample_db_fn != None), "need to give either samples or db plus sample_db_fn"
+  assert samples is not None or (db is not None and sample_db_fn is not None), "need to give either samples or db plus sample_db_fn"
   if db:
     samples = sample_db_fn(db)
+  index = SampleIndex.of(samples)
 
   q_img, q_cls, q_hist = query['img'], query['cls'], query['hist']
-  results = []
-  for idx, sample in enumerate(samples):
-    s_img, s_cls, s_hist = sample['img'], sample['cls'], sample['hist']
-    if q_img == s_img:
-      continue
-    results.append({
-                    'dis': distance(q_hist, s_hist, d_type=d_type),
-                    'cls': s_cls
-                  })
-  results = sorted(results, key=lambda x: x['dis'])
-  if depth and depth <= len(results):
-    results = results[:depth]
-  ap = AP(q_cls, results, sort=False)
+  candidates = np.flatnonzero(index.img != q_img)
+  dis = distance_matrix(q_hist, index, d_type=d_type)[0, candidates]
+
+  k = min(depth, len(dis)) if depth else len(dis)
+  top = _top_k(dis, k)
+  results = [{
+               'dis': float(dis[i]),
+               'cls': index.cls[candidates[i]]
+             } for i in top]
+  ap = _average_precision(index.cls[candidates[top]] == q_cls)
 
   return ap, results
 
 
+def evaluate_all_pairs(index, depths=(None,), d_type='d1', block_size=None):
+  ''' infer every sample of the index against all the others
+
+    distances are computed for blocks of queries at once, each query is ranked a single time
+    and its ap is read for every depth from cumulative hit counts along that ranking
+
+    arguments
+      index     : an instance of class SampleIndex
+      depths    : retrieved depths during inference, None is equal to database size
+      d_type    : distance type
+      block_size: number of queries per block, by default sized to keep a block around block_bytes
+
+    return
+      a dict {depth: {class: [ap of each query of this class, in samples order]}}
+  '''
+  n = len(index)
+  img_id, cls_id = index.img_id, index.cls_id
+  ret = {d: {} for d in depths}
+  if n == 0:
+    return ret
+
+  # a full ranking is only needed when a depth covers the whole database
+  finite = [d for d in depths if d]
+  K = n if len(finite) < len(depths) else min(max(finite), n)
+  if block_size is None:
+    block_size = max(1, block_bytes // (n * 8 * 4))
+
+  aps = {d: np.zeros(n) for d in depths}
+  for start in range(0, n, block_size):
+    rows = np.arange(start, min(start+block_size, n))
+    dis = distance_matrix(index.hist[rows], index, d_type=d_type).astype(np.float64)
+
+    # undefined distances (cosine of a zero vector) rank last, after infinite ones, like infer's
+    # sort does; self matches are pushed behind all of them, then cut by n_valid
+    top = np.finfo(np.float64).max
+    dis = np.nan_to_num(dis, nan=top, posinf=np.nextafter(top, 0))
+    same = img_id[rows][:, None] == img_id[None, :]
+    dis[same] = np.inf
+    n_valid = n - np.count_nonzero(same, axis=1)
+
+    if K < n:
+      rank = _top_k_rows(dis, K)
+    else:
+      rank = np.argsort(dis, axis=1, kind='stable')
+
+    hits = cls_id[rank] == cls_id[rows][:, None]
+    n_hits = np.cumsum(hits, axis=1)
+    sum_precision = np.cumsum(hits * (n_hits / np.arange(1., rank.shape[1]+1)), axis=1)
+
+    for d in depths:
+      k = np.minimum(d, n_valid) if d else n_valid
+      col = np.maximum(k-1, 0)
+      r = np.arange(len(rows))
+      found = np.where(k > 0, n_hits[r, col], 0)
+      aps[d][rows] = np.where(found > 0, sum_precision[r, col] / np.maximum(found, 1), 0.)
+
+  for d in depths:
+    for cls, ap in zip(index.cls, aps[d]):
+      ret[d].setdefault(cls, []).append(ap)
+  return ret
+
+
 def evaluate(db, sample_db_fn, depth=None, d_type='d1'):
   ''' infer the whole database
 
@@ -120,9 +589,9 @@ def evaluate(db, sample_db_fn, depth=None, d_type='d1'):
   ret = {c: [] for c in classes}
 
   samples = sample_db_fn(db)
-  for query in samples:
-    ap, _ = infer(query, samples=samples, depth=depth, d_type=d_type)
-    ret[query['cls']].append(ap)
+  APs = evaluate_all_pairs(SampleIndex(samples), depths=[depth], d_type=d_type)
+  for cls, cls_APs in APs[depth].items():
+    ret[cls].extend(cls_APs)
 
   return ret
 
@@ -136,18 +605,34 @@ def evaluate_class(db, f_class=None, f_instance=None, depth=None, d_type='d1'):
       depth  : retrieved depth during inference, the default depth is equal to database size
       d_type : distance type
   '''
+  return evaluate_class_depths(db, f_class=f_class, f_instance=f_instance, depths=[depth], d_type=d_type)[depth]
+
+
+def evaluate_class_depths(db, f_class=None, f_instance=None, depths=(None,), d_type='d1'):
+  ''' infer the whole database for several depths, ranking each query only once
+
+    arguments
+      db     : an instance of class Database
+      f_class: a class that generate features, needs to implement make_samples method
+      depths : retrieved depths during inference, None is equal to database size
+      d_type : distance type
+
+    return
+      a dict {depth: {class: [ap of each query of this class]}}, like evaluate_class for each depth
+  '''
   assert f_class or f_instance, "needs to give class_name or an instance of class"
 
   classes = db.get_class()
-  ret = {c: [] for c in classes}
+  ret = {d: {c: [] for c in classes} for d in depths}
 
   if f_class:
     f = f_class()
   elif f_instance:
     f = f_instance
   samples = f.make_samples(db)
-  for query in samples:
-    ap, _ = infer(query, samples=samples, depth=depth, d_type=d_type)
-    ret[query['cls']].append(ap)
+  APs = evaluate_all_pairs(SampleIndex(samples), depths=depths, d_type=d_type)
+  for d in depths:
+    for cls, cls_APs in APs[d].items():
+      ret[d][cls].extend(cls_APs)
 
   return ret
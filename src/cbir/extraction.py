@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from image_loader import load_image, iter_images
+from precision import precisions, compute_dtype, default_precision
+from feature_store import FeatureStore
+
+import multiprocessing
+import numpy as np
+import sys
+
+
+# default number of worker processes, 1 extracts in the calling process
+n_workers = 1
+# number of images sent to a worker at once
+chunksize = 16
+
+# state of a worker process, set by _init_worker
+_worker_jobs       = None
+_worker_image_size = None
+
+
+def _init_worker(jobs, image_size):
+  global _worker_jobs, _worker_image_size
+  _worker_jobs       = jobs
+  _worker_image_size = image_size
+
+
+def _extract_one(task, img=None):
+  ''' features of the image of task = (path, indices of the jobs to run on it) '''
+  path, needs = task
+  if img is None:
+    img = load_image(path, image_size=_worker_image_size)
+  hists = []
+  for j in needs:
+    extractor, kwargs, dtype = _worker_jobs[j]
+    hists.append(np.asarray(extractor.histogram(img, **kwargs), dtype=dtype))
+  return hists
+
+
+def _run_jobs(jobs, paths, needs, n_workers=n_workers, chunksize=chunksize, verbose=True, image_size=None):
+  ''' decode every path once and run on it the jobs listed in needs
+
+    arguments
+      jobs : a list of (extractor, histogram kwargs, dtype)
+      paths: list of image paths
+      needs: indices of the jobs to run on each path
+
+    return
+      a list with, for each job, a numpy array of the features of the paths needing it, in order
+  '''
+  n = len(paths)
+  tasks = list(zip(paths, needs))
+
+  if n_workers > 1 and n > 1:
+    pool = multiprocessing.Pool(min(n_workers, n), initializer=_init_worker, initargs=(jobs, image_size))
+    results = pool.imap(_extract_one, tasks, chunksize=chunksize)
+  else:
+    pool = None
+    _init_worker(jobs, image_size)
+    results = (_extract_one(task, img) for task, (_, img) in zip(tasks, iter_images(paths, image_size=image_size)))
+
+  n_rows = np.bincount([j for need in needs for j in need], minlength=len(jobs))
+  hists = [None] * len(jobs)
+  filled = [0] * len(jobs)
+  try:
+    for idx, (task, job_hists) in enumerate(zip(tasks, results)):
+      for j, hist in zip(task[1], job_hists):
+        if hists[j] is None:
+          hists[j] = np.empty((n_rows[j], hist.size), dtype=jobs[j][2])
+        hists[j][filled[j]] = hist
+        filled[j] += 1
+      if verbose and ((idx+1) % chunksize == 0 or idx+1 == n):
+        sys.stdout.write("\rExtracting features... %d/%d" % (idx+1, n))
+        sys.stdout.flush()
+  except:
+    if pool is not None:
+      pool.terminate()
+    raise
+  if pool is not None:
+    pool.close()
+    pool.join()
+  if verbose and n:
+    print()
+
+  return [h if h is not None else np.empty((0, 0), dtype=job[2]) for h, job in zip(hists, jobs)]
+
+
+def extract_features(extractor, paths, n_workers=n_workers, chunksize=chunksize, verbose=True, dtype=np.float32,
+                     image_size=None, **kwargs):
+  ''' compute extractor.histogram(image, **kwargs) for the image of every path
+
+    in the calling process, images are decoded ahead on threads by image_loader.iter_images,
+    otherwise paths are sent by chunks to a pool of worker processes which decode them and
+    send back compact arrays of type dtype, written in the order of paths into one
+    preallocated matrix
+
+    arguments
+      extractor: an instance of a feature class implementing histogram, e.g. Color() or Edge()
+      paths    : list of image paths
+      n_workers: number of worker processes, 1 extracts in the calling process
+      chunksize: number of images per task sent to a worker
+      verbose  : print a progress counter
+      dtype    : type of the features, float32 unless they are stored in float64, see precision.py
+      image_size: size images are decoded at, see image_loader.load_image
+      kwargs   : passed to extractor.histogram
+
+    return
+      a numpy array of type dtype with shape (len(paths), dims)
+  '''
+  return _run_jobs([(extractor, kwargs, dtype)], paths, [(0,)] * len(paths), n_workers=n_workers,
+                   chunksize=chunksize, verbose=verbose, image_size=image_size)[0]
+
+
+def extract_stores(extractors, db, n_workers=n_workers, chunksize=chunksize, verbose=True, precision=default_precision):
+  ''' bring the caches of several extractors up to date in a single pass over the images
+
+    every image missing from at least one cache is decoded once, then handed to each extractor
+    needing it, extractors decoding images at different sizes (see decode_size) get one pass
+    per size
+
+    arguments
+      extractors: instances of feature classes implementing histogram, feature_cache,
+                  histogram_kwargs and decode_size, e.g. [Color(), Edge()]
+      db        : an instance of class Database
+      n_workers : see extract_features
+      chunksize : see extract_features
+      precision : precision the features are stored with, see precision.py
+
+    return
+      a list with the FeatureStore of each extractor
+  '''
+  dtype = compute_dtype(precisions[precision])
+  caches = [extractor.feature_cache(precision) for extractor in extractors]
+  plans = [cache.plan(db, verbose=verbose) for cache in caches]
+
+  groups = {}
+  for k, extractor in enumerate(extractors):
+    size = extractor.decode_size()
+    groups.setdefault(tuple(size) if size else None, []).append(k)
+
+  hists = [None] * len(extractors)
+  for size, members in groups.items():
+    todo = [set(plans[k]['todo'].tolist()) for k in members]
+    images = sorted(set().union(*todo))
+    paths = [plans[members[0]]['img'][idx] for idx in images]
+    needs = [tuple(j for j in range(len(members)) if idx in todo[j]) for idx in images]
+    jobs = [(extractors[k], extractors[k].histogram_kwargs(), dtype) for k in members]
+    for k, h in zip(members, _run_jobs(jobs, paths, needs, n_workers=n_workers, chunksize=chunksize,
+                                       verbose=verbose, image_size=size)):
+      hists[k] = h
+
+  return [cache.commit(plan, h) for cache, plan, h in zip(caches, plans, hists)]
+
+
+def extract_sweep(extractor, db, verbose=True, **kwargs):
+  ''' features of a database for every setting of a parameter sweep, in one pass over the images
+
+    every image is decoded once and given to extractor.sweep, which reads all the settings
+    from a single integral representation of the image
+
+    arguments
+      extractor: an instance of a feature class implementing sweep, e.g. Color() or Edge()
+      db       : an instance of class Database
+      kwargs   : passed to extractor.sweep, e.g. n_bins=(6, 12), n_slices=(2, 3, 4)
+
+    return
+      a dict {setting: FeatureStore of the database features with this setting}
+  '''
+  data = db.get_data()
+  paths, classes = list(data["img"]), list(data["cls"])
+  hists = {}
+  for idx, (path, img) in enumerate(iter_images(paths)):
+    for setting, hist in extractor.sweep(img, **kwargs).items():
+      if setting not in hists:
+        hists[setting] = np.empty((len(paths), hist.size), dtype=np.float32)
+      hists[setting][idx] = hist
+    if verbose and ((idx+1) % chunksize == 0 or idx+1 == len(paths)):
+      sys.stdout.write("\rExtracting features... %d/%d" % (idx+1, len(paths)))
+      sys.stdout.flush()
+  if verbose and paths:
+    print()
+  return {setting: FeatureStore.from_arrays(hist, paths, classes) for setting, hist in hists.items()}
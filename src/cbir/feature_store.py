@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from precision import QuantizedMatrix, encode, precision_of, compute_dtype, precisions, default_precision, resolution
+
+import numpy as np
+import hashlib
+import shutil
+import json
+import os
+
+
+class FeatureStore(object):
+  ''' columnar storage of the features of a database
+
+    a store is saved as a directory of .npy files
+      hist.npy   : the feature matrix, one row per image, float32 unless saved with another precision
+      img.npy    : path of each image
+      cls.npy    : class id of each image
+      classes.npy: class names, indexed by class id
+      signature.npy (optional): signature of each image file, see image_signature
+      scale.npy     (optional): scale of each row of a uint16 matrix, see precision.QuantizedMatrix
+      offset.npy    (optional): offset of each row of a uint16 matrix, zeros if missing
+
+    the matrix is memory-mapped when loading, so processes opening the same store
+    share its pages instead of holding their own copy
+
+    arguments
+      hist   : a numpy array with shape (n_images, dims), or a precision.QuantizedMatrix
+      img    : a numpy array of image paths
+      cls_id : a numpy array of class ids
+      classes  : a list of class names
+      signature: a numpy array of image signatures, or None
+  '''
+
+  files = ('hist', 'img', 'cls', 'classes')
+
+  def __init__(self, hist, img, cls_id, classes, signature=None):
+    assert len(hist) == len(img) == len(cls_id), "all columns need to have the same length!"
+    self.hist      = hist
+    self.img       = img
+    self.cls_id    = cls_id
+    self.classes   = list(classes)
+    self.signature = signature
+
+  @classmethod
+  def from_arrays(cls, hist, img, classes_of_img, dtype=np.float32, precision=None):
+    ''' build a store from features and the class name of each image
+
+      the matrix is stored with precision if given, see precision.py, else with dtype
+    '''
+    ids = {}
+    cls_id = np.array([ids.setdefault(c, len(ids)) for c in classes_of_img], dtype=np.int32)
+    classes = sorted(ids, key=ids.get)
+    if not isinstance(hist, QuantizedMatrix):
+      hist = np.ascontiguousarray(hist, dtype=dtype if precision is None else compute_dtype(precisions[precision]))
+      if hist.ndim != 2:
+        hist = hist.reshape(len(cls_id), -1 if len(cls_id) else 0)
+    if precision is not None:
+      hist = encode(hist, precision)
+    return cls(hist, np.asarray(img, dtype=str), cls_id, classes)
+
+  @classmethod
+  def from_samples(cls, samples, dtype=None):
+    ''' build a store from a list of {'img', 'cls', 'hist'} dicts, or return the store behind them
+
+      the store behind samples is returned as is when dtype is None or its matrix has this type,
+      new stores are float32 unless dtype is given
+    '''
+    store = samples if isinstance(samples, FeatureStore) else getattr(samples, 'store', None)
+    if store is not None and len(store) == len(samples) and (dtype is None or store.hist.dtype == dtype):
+      return store
+    return cls.from_arrays([s['hist'] for s in samples], [s['img'] for s in samples],
+                           [s['cls'] for s in samples], dtype=dtype or np.float32)
+
+  @classmethod
+  def exists(cls, path):
+    return all(os.path.isfile(os.path.join(path, f + '.npy')) for f in cls.files)
+
+  @classmethod
+  def load(cls, path, mmap_mode='r'):
+    ''' open a store saved with save, the feature matrix is memory-mapped unless mmap_mode is None '''
+    hist    = np.load(os.path.join(path, 'hist.npy'), mmap_mode=mmap_mode)
+    img     = np.load(os.path.join(path, 'img.npy'))
+    cls_id  = np.load(os.path.join(path, 'cls.npy'))
+    classes = np.load(os.path.join(path, 'classes.npy')).tolist()
+    signature = None
+    if os.path.isfile(os.path.join(path, 'signature.npy')):
+      signature = np.load(os.path.join(path, 'signature.npy'))
+    if os.path.isfile(os.path.join(path, 'scale.npy')):
+      offset = None
+      if os.path.isfile(os.path.join(path, 'offset.npy')):
+        offset = np.load(os.path.join(path, 'offset.npy'))
+      hist = QuantizedMatrix(hist, np.load(os.path.join(path, 'scale.npy')), offset)
+    return cls(hist, img, cls_id, classes, signature=signature)
+
+  def save(self, path, extra_files=None):
+    ''' write the store to a directory, replacing it only once every file is written
+
+      arguments
+        path       : directory of the store
+        extra_files: a dict {file name: text content} written along the arrays
+    '''
+    tmp_path = self._save_columns(path, extra_files)
+    if isinstance(self.hist, QuantizedMatrix):
+      np.save(os.path.join(tmp_path, 'hist.npy'), np.ascontiguousarray(self.hist.counts))
+      np.save(os.path.join(tmp_path, 'scale.npy'), self.hist.scale)
+      np.save(os.path.join(tmp_path, 'offset.npy'), self.hist.offset)
+    else:
+      np.save(os.path.join(tmp_path, 'hist.npy'), np.ascontiguousarray(self.hist))
+    self._replace(tmp_path, path)
+
+  def transform(self, path, fn, batch_size=4096):
+    ''' save at path a new store whose matrix is fn applied on blocks of rows of this one
+
+      blocks are read from the memory-mapped matrix and written to a memory-mapped output,
+      so stores larger than memory can be transformed
+
+      arguments
+        path      : directory of the new store
+        fn        : a function mapping a (n, dims) numpy array to a (n, new_dims) one
+        batch_size: number of rows per block
+
+      return
+        the new FeatureStore, loaded from path
+    '''
+    tmp_path = self._save_columns(path)
+    hist = None
+    for start in range(0, len(self), batch_size):
+      block = np.asarray(fn(self.hist[start:start+batch_size]), dtype=np.float32)
+      if hist is None:
+        hist = np.lib.format.open_memmap(os.path.join(tmp_path, 'hist.npy'), mode='w+',
+                                         dtype=np.float32, shape=(len(self), block.shape[1]))
+      hist[start:start+len(block)] = block
+    if hist is None:
+      np.save(os.path.join(tmp_path, 'hist.npy'), np.empty((0, 0), dtype=np.float32))
+    else:
+      hist.flush()
+      del hist
+    self._replace(tmp_path, path)
+    return FeatureStore.load(path)
+
+  def _save_columns(self, path, extra_files=None):
+    ''' write every file but the matrix into a temporary directory and return its path '''
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, content in (extra_files or {}).items():
+      with open(os.path.join(tmp_path, name), 'w', encoding='UTF-8') as f:
+        f.write(content)
+    if self.signature is not None:
+      np.save(os.path.join(tmp_path, 'signature.npy'), np.asarray(self.signature, dtype=str))
+    np.save(os.path.join(tmp_path, 'img.npy'), np.asarray(self.img, dtype=str))
+    np.save(os.path.join(tmp_path, 'cls.npy'), np.asarray(self.cls_id, dtype=np.int32))
+    np.save(os.path.join(tmp_path, 'classes.npy'), np.asarray(self.classes))
+    return tmp_path
+
+  def _replace(self, tmp_path, path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+  @property
+  def precision(self):
+    ''' precision the matrix is stored with, see precision.py '''
+    return precision_of(self.hist)
+
+  @property
+  def cls(self):
+    ''' class name of each image '''
+    return np.asarray(self.classes, dtype=object)[self.cls_id]
+
+  def __len__(self):
+    return len(self.hist)
+
+  def as_samples(self):
+    ''' expose the store with the list of {'img', 'cls', 'hist'} interface of make_samples
+
+      nothing is copied, see StoreSamples
+    '''
+    return StoreSamples(self)
+
+
+def align_stores(stores):
+  ''' rows of the images common to several stores, aligned on image path
+
+    return
+      (a numpy array with shape (n_common, len(stores)), the row of each common image in each
+       store, in the order of the first one,
+       a list of the image paths dropped because they are missing from some store)
+  '''
+  first = stores[0]
+  rows = [{img: row for row, img in enumerate(store.img.tolist())} for store in stores]
+  keep, dropped = [], set()
+  for img in first.img.tolist():
+    aligned = [r.get(img) for r in rows]
+    if None in aligned:
+      dropped.add(img)
+    else:
+      keep.append(aligned)
+  keep = np.array(keep, dtype=np.intp).reshape(-1, len(stores))
+  for r in rows[1:]:
+    dropped.update(img for img in r if img not in rows[0])
+  for k, store in enumerate(stores):
+    assert (store.cls[keep[:, k]] == first.cls[keep[:, 0]]).all(), "an image has different classes in two stores!"
+  return keep, sorted(dropped)
+
+
+def join_stores(stores, dtype=np.float32, copy=True):
+  ''' concatenate horizontally the features of several stores, aligned on image path
+
+    each store is indexed by image path once, then the aligned rows of every store are copied
+    into their columns of a single preallocated matrix, or served by a JoinedMatrix
+
+    arguments
+      stores: a list of FeatureStore
+      dtype : type of the fused matrix
+      copy  : False to fuse the matrices into a JoinedMatrix, which reads the columns of each
+              store when its rows are accessed instead of copying them
+
+    return
+      (a FeatureStore with the images of all stores, in the order of the first one,
+       a list of the image paths dropped because they are missing from some store)
+  '''
+  if len(stores) == 1:
+    return stores[0], []
+
+  first = stores[0]
+  keep, dropped = align_stores(stores)
+  if not copy:
+    rows = [None if len(keep) == len(store) and (keep[:, k] == np.arange(len(store))).all() else keep[:, k]
+            for k, store in enumerate(stores)]
+    hist = JoinedMatrix([store.hist for store in stores], rows, dtype=dtype)
+  else:
+    dims = [store.hist.shape[1] for store in stores]
+    hist = np.empty((len(keep), sum(dims)), dtype=dtype)
+    start = 0
+    for k, (store, dim) in enumerate(zip(stores, dims)):
+      hist[:, start:start+dim] = store.hist[keep[:, k]]
+      start += dim
+
+  fused = FeatureStore(hist, first.img[keep[:, 0]], first.cls_id[keep[:, 0]], first.classes)
+  return fused, dropped
+
+
+class JoinedMatrix(object):
+  ''' horizontal concatenation of matrices, computed on the rows accessed
+
+    indexing and iterating give the concatenated rows, like the copied matrix would, so it can
+    replace the matrix of a FeatureStore; evaluate.SampleIndex reads it by blocks of rows
+
+    arguments
+      blocks: matrices with the same number of aligned rows, numpy arrays (may be memory-mapped)
+              or precision.QuantizedMatrix
+      rows  : for each block, the numpy array of its row behind each row of the matrix, or None
+              when they are the same
+      dtype : type of the concatenated rows
+  '''
+
+  def __init__(self, blocks, rows, dtype=np.float32):
+    self.blocks = list(blocks)
+    self.rows   = list(rows)
+    self.dtype  = np.dtype(dtype)
+    lengths = [len(block) if index is None else len(index) for block, index in zip(self.blocks, self.rows)]
+    assert len(set(lengths)) == 1, "blocks need to have the same number of rows!"
+    self._len = lengths[0]
+
+  @property
+  def shape(self):
+    return (self._len, sum(block.shape[1] for block in self.blocks))
+
+  @property
+  def ndim(self):
+    return 2
+
+  def __len__(self):
+    return self._len
+
+  def __getitem__(self, key):
+    if isinstance(key, tuple):
+      rows, cols = key
+      if np.ndim(rows) == 2:
+        # np.ix_ key
+        return self[np.ravel(rows)][:, np.ravel(cols)]
+      return self[rows][..., cols]
+    if isinstance(key, slice):
+      key = np.arange(*key.indices(self._len)) if any(index is not None for index in self.rows) else key
+    parts = [block[key] if index is None else block[index[key]] for block, index in zip(self.blocks, self.rows)]
+    return np.concatenate([np.asarray(part, dtype=self.dtype) for part in parts], axis=-1)
+
+  def __iter__(self):
+    for start in range(0, len(self), 4096):
+      for row in self[start:start+4096]:
+        yield row
+
+  def __array__(self, dtype=None, copy=None):
+    hist = self[:]
+    return hist if dtype is None else hist.astype(dtype)
+
+
+class StoreSamples(list):
+  ''' samples backed by a FeatureStore, keeps a reference to it in the store attribute
+
+    the 'hist' of each sample is a row view of a numpy matrix, rows of other matrices, which
+    are decoded or gathered on read, are only read when 'hist' is accessed
+  '''
+
+  def __init__(self, store):
+    classes = store.classes
+    if isinstance(store.hist, np.ndarray):
+      samples = ({'img': img, 'cls': classes[c], 'hist': hist}
+                 for img, c, hist in zip(store.img.tolist(), store.cls_id.tolist(), store.hist))
+    else:
+      samples = (_StoreSample(store.hist, row, img=img, cls=classes[c])
+                 for row, (img, c) in enumerate(zip(store.img.tolist(), store.cls_id.tolist())))
+    super(StoreSamples, self).__init__(samples)
+    self.store = store
+
+
+class _StoreSample(dict):
+  ''' sample dict whose 'hist' is read from row of matrix on access '''
+
+  __slots__ = ('_matrix', '_row')
+
+  def __init__(self, matrix, row, **kwargs):
+    super(_StoreSample, self).__init__(**kwargs)
+    self._matrix = matrix
+    self._row    = row
+
+  def __missing__(self, key):
+    if key == 'hist':
+      return self._matrix[self._row]
+    raise KeyError(key)
+
+
+def image_signature(path, content_hash=False):
+  ''' a string that changes when the image file changes
+
+    arguments
+      path        : path to the image
+      content_hash: if true, use the md5 of the file content instead of its modification time and size
+  '''
+  if content_hash:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        md5.update(chunk)
+    return md5.hexdigest()
+  stat = os.stat(path)
+  return "%d:%d" % (stat.st_mtime_ns, stat.st_size)
+
+
+class FeatureCache(object):
+  ''' incremental FeatureStore cache of the features of a database
+
+    rows are keyed by image path and checked against the image signature and the extractor
+    config, so that an update only extracts new or modified images and drops deleted ones
+
+    arguments
+      path        : directory of the FeatureStore
+      config      : a dict of the extractor settings, the whole cache is rebuilt when it changes
+      content_hash: compare image files by content instead of modification time and size
+      precision   : precision the features are stored with, see precision.py, a cache saved with
+                    another precision is converted without extracting its images again, unless
+                    it holds less significant bits than precision
+  '''
+
+  def __init__(self, path, config, content_hash=False, precision=default_precision):
+    assert precision in precisions, "precision %s isn't supported!" % precision
+    self.path         = path
+    self.config       = dict(config, content_hash=content_hash)
+    self.content_hash = content_hash
+    self.precision    = precision
+
+  def load(self, verbose=True):
+    ''' return the cached FeatureStore, or None with the reason if it can't be reused '''
+    reason = None
+    if not FeatureStore.exists(self.path):
+      reason = "no cache found"
+    else:
+      try:
+        with open(os.path.join(self.path, 'config.json'), encoding='UTF-8') as f:
+          config = json.load(f)
+        config.pop('precision', None)
+        store = FeatureStore.load(self.path)
+      except (IOError, OSError, ValueError) as e:
+        reason = "unreadable cache (%s)" % e
+      else:
+        if config != self.config:
+          reason = "extractor config changed from %s" % config
+        elif store.signature is None:
+          reason = "cache has no image signatures"
+        elif resolution[store.precision] < resolution[self.precision]:
+          reason = "cache saved with %s, %s requested" % (store.precision, self.precision)
+    if reason:
+      if verbose:
+        print("Rebuilding cache %s: %s" % (self.path, reason))
+      return None
+    return store
+
+  def plan(self, db, verbose=True):
+    ''' compare the database with the cache
+
+      return
+        a dict with the keys
+          'img', 'cls', 'signature': columns of the up to date store, in database order
+          'reuse': row of each image in the cached store, -1 if it needs to be extracted
+          'store': the cached FeatureStore or None
+          'todo' : indices of the images to extract
+    '''
+    data = db.get_data()
+    imgs, classes = list(data["img"]), list(data["cls"])
+    signatures = [image_signature(img, self.content_hash) for img in imgs]
+
+    store = self.load(verbose=verbose)
+    cached = {}
+    if store is not None:
+      cached = {img: (row, sig) for row, (img, sig) in enumerate(zip(store.img.tolist(), store.signature.tolist()))}
+
+    reuse = np.full(len(imgs), -1, dtype=np.intp)
+    for idx, (img, sig) in enumerate(zip(imgs, signatures)):
+      row, cached_sig = cached.get(img, (-1, None))
+      if cached_sig == sig:
+        reuse[idx] = row
+
+    plan = {
+      'img': imgs,
+      'cls': classes,
+      'signature': signatures,
+      'reuse': reuse,
+      'store': store,
+      'todo': np.flatnonzero(reuse < 0),
+    }
+    if verbose and store is not None:
+      n_deleted = len(set(cached) - set(imgs))
+      print("Cache %s: %d images to extract, %d deleted" % (self.path, len(plan['todo']), n_deleted))
+    return plan
+
+  def commit(self, plan, hists):
+    ''' merge the features extracted for plan['todo'] with the cached ones and save the store
+
+      arguments
+        plan : output of plan
+        hists: features of the images plan['todo'], in the same order
+    '''
+    store, reuse, todo = plan['store'], plan['reuse'], plan['todo']
+    unchanged = (store is not None and len(todo) == 0 and len(store) == len(reuse)
+                 and np.array_equal(reuse, np.arange(len(reuse)))
+                 and store.cls.tolist() == plan['cls'] and store.precision == self.precision)
+    if unchanged:
+      return store
+
+    dtype = compute_dtype(precisions[self.precision])
+    hists = np.asarray(hists, dtype=dtype)
+    if store is not None:
+      dims = store.hist.shape[1]
+    else:
+      dims = hists.shape[1] if hists.ndim == 2 else 0
+    assert len(todo) == 0 or hists.shape[1] == dims, "extracted features don't match the cached ones!"
+
+    hist = np.empty((len(reuse), dims), dtype=dtype)
+    kept = reuse >= 0
+    if kept.any():
+      hist[kept] = store.hist[reuse[kept]]
+    if len(todo):
+      hist[todo] = hists
+    new_store = FeatureStore.from_arrays(hist, plan['img'], plan['cls'], precision=self.precision)
+    new_store.signature = np.asarray(plan['signature'], dtype=str)
+    config = dict(self.config, precision=self.precision)
+    new_store.save(self.path, extra_files={'config.json': json.dumps(config, sort_keys=True)})
+    return FeatureStore.load(self.path)
+
+  def update(self, db, extract, verbose=True, message=None):
+    ''' bring the cache up to date with the database and return its FeatureStore
+
+      arguments
+        db     : an instance of class Database
+        extract: a function mapping a list of image paths to their features
+        message: printed when verbose, after "Using cache..." when every image is cached
+                 or "Counting histogram..." when some need to be extracted
+    '''
+    plan = self.plan(db, verbose=verbose)
+    paths = [plan['img'][idx] for idx in plan['todo']]
+    if verbose and message:
+      print("%s, %s" % ("Counting histogram..." if paths else "Using cache...", message))
+    return self.commit(plan, extract(paths) if paths else [])
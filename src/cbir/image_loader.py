@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from PIL import Image
+
+import numpy as np
+
+
+''' Image decoding shared by the extractors
+
+    images are decoded with PIL into read-only uint8 arrays of shape (height, width, 3), which
+    the extractors only read, so one decoded image can be handed to several of them
+
+    JPEG files can be decoded at reduced size (draft mode, 1/2, 1/4 or 1/8 of the full size)
+    when an extractor doesn't need full resolution, which skips most of the decoding work
+'''
+
+
+# default number of decoding threads, PIL releases the GIL while decoding
+n_threads  = 4
+# number of images per batch
+batch_size = 32
+# number of batches decoded ahead of the one being consumed
+prefetch   = 2
+
+
+def load_image(path, image_size=None, mode='RGB'):
+  ''' decode an image into a read-only numpy array
+
+    arguments
+      path      : path to the image
+      image_size: (height, width) the image needs to cover at least, JPEG files are decoded at
+                  the smallest reduced size above it, None decodes at full resolution
+      mode      : PIL mode of the output, 'RGB' gives arrays of shape (height, width, 3)
+
+    return
+      a uint8 numpy array, not writeable
+  '''
+  with Image.open(path) as img:
+    if image_size is not None:
+      img.draft(mode, (image_size[1], image_size[0]))
+    if img.mode != mode:
+      img = img.convert(mode)
+    array = np.asarray(img)
+  array.flags.writeable = False
+  return array
+
+
+def iter_batches(paths, image_size=None, mode='RGB', batch_size=batch_size, n_threads=n_threads, prefetch=prefetch):
+  ''' decode images by batches on a thread pool, in the order of paths
+
+    up to prefetch batches are decoded while the current one is consumed
+
+    arguments
+      paths     : list of image paths
+      image_size: see load_image
+      mode      : see load_image
+      batch_size: number of images per batch
+      n_threads : number of decoding threads
+      prefetch  : number of batches decoded ahead
+
+    return
+      a generator of lists of (path, image) tuples, images as given by load_image
+  '''
+  batches = [paths[start:start+batch_size] for start in range(0, len(paths), batch_size)]
+  with ThreadPoolExecutor(max_workers=max(1, n_threads)) as pool:
+    pending = deque()
+    for batch in batches:
+      pending.append((batch, [pool.submit(load_image, path, image_size, mode) for path in batch]))
+      if len(pending) > prefetch:
+        batch, futures = pending.popleft()
+        yield list(zip(batch, [f.result() for f in futures]))
+    while pending:
+      batch, futures = pending.popleft()
+      yield list(zip(batch, [f.result() for f in futures]))
+
+
+def iter_images(paths, **kwargs):
+  ''' (path, image) of every path, in order, decoded as iter_batches does '''
+  for batch in iter_batches(paths, **kwargs):
+    for item in batch:
+      yield item
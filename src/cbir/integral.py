@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import numpy as np
+
+
+''' Integral representations of an image for region features
+
+    a region feature is a sum over the pixels, or filter positions, of a rectangle; once the
+    cumulative sums over both axes are known, the sum over any rectangle is read from its four
+    corners, so every grid of regions costs O(regions x values) instead of a pass over the pixels
+
+      IntegralHistogram: cumulative histograms on a lattice of cut positions, used by Color
+      IntegralMap      : summed-area tables of a strided response map, used by Edge
+'''
+
+
+def slice_cuts(size, n_slice):
+  ''' boundaries of n_slice equal slices of size pixels, as histogram functions cut images '''
+  return np.around(np.linspace(0, size, n_slice+1, endpoint=True)).astype(int)
+
+
+def lattice(size, n_slices):
+  ''' sorted union of the cuts of every slice count in n_slices '''
+  return np.unique(np.concatenate([slice_cuts(size, n) for n in n_slices]))
+
+
+def _corners(table, r0, r1, c0, c1):
+  ''' sums of the rectangles [r0, r1) x [c0, c1) of an integral table with a leading zero row and column,
+      r* and c* being index arrays broadcast against each other '''
+  return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+
+class IntegralHistogram(object):
+  ''' integral of histograms over a lattice of cut positions
+
+    pixels are counted once per cell of the lattice, then counts are accumulated along both
+    axes, so that the histogram of any rectangle whose sides lie on the lattice is exact
+
+    arguments
+      cells: a numpy array with shape (len(rows)-1, len(cols)-1, n_values), histogram of each cell
+      rows : row cut positions of the lattice, starting at 0 and ending at the image height
+      cols : column cut positions of the lattice, starting at 0 and ending at the image width
+  '''
+
+  def __init__(self, cells, rows, cols):
+    self.rows = np.asarray(rows)
+    self.cols = np.asarray(cols)
+    n_h, n_w, n_values = cells.shape
+    # pixel counts fit in 32 bits, which halves the memory traffic of the cumulative sums
+    dtype = np.int32 if np.issubdtype(cells.dtype, np.integer) else cells.dtype
+    self.table = np.zeros((n_h+1, n_w+1, n_values), dtype=dtype)
+    np.cumsum(cells, axis=0, dtype=dtype, out=self.table[1:, 1:])
+    np.cumsum(self.table[1:, 1:], axis=1, out=self.table[1:, 1:])
+
+  @property
+  def height(self):
+    return int(self.rows[-1])
+
+  @property
+  def width(self):
+    return int(self.cols[-1])
+
+  def _index(self, cuts, lattice_cuts):
+    idx = np.searchsorted(lattice_cuts, cuts)
+    assert (idx < len(lattice_cuts)).all() and (lattice_cuts[idx] == cuts).all(), \
+      "cuts need to lie on the lattice the integral histogram was built with!"
+    return idx
+
+  def region(self, h_range, w_range):
+    ''' histogram of the pixels of rows [h_range) and columns [w_range) '''
+    (r0, r1), (c0, c1) = self._index(np.array(h_range), self.rows), self._index(np.array(w_range), self.cols)
+    return _corners(self.table, r0, r1, c0, c1)
+
+  def grid(self, n_h, n_w=None):
+    ''' histograms of the n_h x n_w regions of the image, with shape (n_h, n_w, n_values) '''
+    r = self._index(slice_cuts(self.height, n_h), self.rows)
+    c = self._index(slice_cuts(self.width, n_w or n_h), self.cols)
+    return _corners(self.table, r[:-1, None], r[1:, None], c[None, :-1], c[None, 1:])
+
+  def pyramid(self, levels):
+    ''' concatenation of the flattened grids of every level, e.g. levels (1, 2, 4) '''
+    return np.concatenate([self.grid(n).ravel() for n in levels])
+
+  def rebin(self, factor, n_channel):
+    ''' integral histogram of coarser bins, merging factor consecutive bins of every channel
+
+      bins are packed with the first channel most significant, n_bin bins per channel
+    '''
+    n_h, n_w, n_values = self.table.shape
+    n_bin = int(round(n_values ** (1. / n_channel)))
+    assert n_bin ** n_channel == n_values and n_bin % factor == 0, "bins can't be merged by %d!" % factor
+    shape = (n_h, n_w) + (n_bin // factor, factor) * n_channel
+    merged = self.table.reshape(shape).sum(axis=tuple(range(3, 3 + 2 * n_channel, 2)))
+    coarse = IntegralHistogram.__new__(IntegralHistogram)
+    coarse.rows, coarse.cols = self.rows, self.cols
+    coarse.table = merged.reshape(n_h, n_w, -1)
+    return coarse
+
+
+class IntegralMap(object):
+  ''' summed-area tables of a response map sampled with a stride
+
+    the positions of a region sampled from its top left corner with stride (sh, sw) share the
+    residue of that corner modulo the stride, so one table is kept for each residue
+
+    arguments
+      response   : a numpy array with shape (n_maps, rows, cols), e.g. Edge._filter output
+      stride     : (sh, sw) sampling stride of the positions
+      kernel_size: (kh, kw) size of the filter, a position needs the whole kernel inside the region
+  '''
+
+  def __init__(self, response, stride, kernel_size):
+    self.stride = tuple(stride)
+    self.kernel_size = tuple(kernel_size)
+    self.n_maps = response.shape[0]
+    # map height and width plus the kernel size give back the image size
+    self.height = response.shape[1] + self.kernel_size[0] - 1
+    self.width = response.shape[2] + self.kernel_size[1] - 1
+    sh, sw = self.stride
+    self.tables = {}
+    for a in range(sh):
+      for b in range(sw):
+        sampled = response[:, a::sh, b::sw]
+        table = np.zeros((self.n_maps, sampled.shape[1]+1, sampled.shape[2]+1))
+        np.cumsum(np.cumsum(sampled, axis=1), axis=2, out=table[:, 1:, 1:])
+        self.tables[a, b] = table
+
+  def region(self, h_range, w_range):
+    ''' sum of every map over the strided positions of rows [h_range) and columns [w_range) '''
+    return self.regions(np.array([h_range[0]]), np.array([h_range[1]]),
+                        np.array([w_range[0]]), np.array([w_range[1]]))[0, 0]
+
+  def regions(self, hs, he, ws, we):
+    ''' sums over the regions of rows [hs[i], he[i]) and columns [ws[j], we[j]),
+        with shape (len(hs), len(ws), n_maps) '''
+    sh, sw = self.stride
+    kh, kw = self.kernel_size
+    hh = np.maximum((he - hs - kh) // sh + 1, 0)
+    ww = np.maximum((we - ws - kw) // sw + 1, 0)
+    out = np.empty((len(hs), len(ws), self.n_maps))
+    for a in range(sh):
+      for b in range(sw):
+        rows = np.flatnonzero(hs % sh == a)
+        cols = np.flatnonzero(ws % sw == b)
+        if len(rows) == 0 or len(cols) == 0:
+          continue
+        table = self.tables[a, b]
+        r0 = hs[rows] // sh
+        c0 = ws[cols] // sw
+        r1, c1 = r0 + hh[rows], c0 + ww[cols]
+        sums = _corners(np.moveaxis(table, 0, -1), r0[:, None], r1[:, None], c0[None, :], c1[None, :])
+        out[np.ix_(rows, cols)] = sums
+    return out
+
+  def grid(self, n_h, n_w=None):
+    ''' sums over the n_h x n_w regions of the image, with shape (n_h, n_w, n_maps) '''
+    r = slice_cuts(self.height, n_h)
+    c = slice_cuts(self.width, n_w or n_h)
+    return self.regions(r[:-1], r[1:], c[:-1], c[1:])
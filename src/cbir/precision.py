@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import numpy as np
+import time
+import os
+
+
+''' Storage precision of feature matrices
+
+      float64: full precision, 8 bytes per value
+      float32: default, 4 bytes per value
+      float16: 2 bytes per value, about 3 significant digits
+      uint16 : 2 bytes per value, counts of a per-row scale, value = offset[row] + count * scale[row]
+               the offset is the smallest value of the row, or 0 if it is positive, and the scale
+               maps the largest value to 65535, so the quantization error of a row is at most
+               1/131070 of its range, zeros of positive rows like color histograms stay exact
+
+    distances are always computed in float32 (float64 for float64 stores), values stored with
+    less precision are decoded by blocks of rows
+'''
+
+
+precisions = {
+  'float64': np.float64,
+  'float32': np.float32,
+  'float16': np.float16,
+  'uint16':  np.uint16,
+}
+
+# precision of the feature stores written by the extractors
+default_precision = 'float32'
+
+# significant bits of a value stored with each precision, a store is only converted to a
+# precision with as many bits or fewer, else its features need to be extracted again
+resolution = {
+  'float64': 53,
+  'float32': 24,
+  'uint16':  16,
+  'float16': 11,
+}
+
+# largest count of a uint16 row
+_max_count = np.iinfo(np.uint16).max
+
+
+def compute_dtype(dtype):
+  ''' type distances over values stored with dtype are computed with '''
+  return np.dtype(np.float64) if np.dtype(dtype) == np.float64 else np.dtype(np.float32)
+
+
+class QuantizedMatrix(object):
+  ''' a matrix stored as uint16 counts, a float32 scale and a float32 offset per row
+
+    indexing and iterating give decoded float32 values, like a float32 numpy array would,
+    so it can replace the matrix of a FeatureStore
+
+    arguments
+      counts: a uint16 numpy array with shape (n_rows, dims), may be memory-mapped
+      scale : a float32 numpy array with shape (n_rows,)
+      offset: a float32 numpy array with shape (n_rows,), zeros if None
+  '''
+
+  dtype = np.dtype(np.float32)
+
+  def __init__(self, counts, scale, offset=None):
+    assert len(counts) == len(scale), "every row needs a scale!"
+    self.counts = counts
+    self.scale  = np.asarray(scale, dtype=np.float32)
+    self.offset = np.zeros(len(scale), dtype=np.float32) if offset is None else np.asarray(offset, dtype=np.float32)
+    assert len(self.offset) == len(self.scale), "every row needs an offset!"
+
+  @classmethod
+  def encode(cls, hist, batch_size=4096):
+    counts = np.empty(hist.shape, dtype=np.uint16)
+    scale = np.empty(len(hist), dtype=np.float32)
+    offset = np.empty(len(hist), dtype=np.float32)
+    for start in range(0, len(hist), batch_size):
+      block = np.asarray(hist[start:start+batch_size], dtype=np.float64)
+      low = np.minimum(block.min(axis=1), 0) if block.shape[1] else np.zeros(len(block))
+      # the offset is rounded to float32 before the counts are computed against it
+      low = low.astype(np.float32).astype(np.float64)
+      top = block.max(axis=1) if block.shape[1] else np.zeros(len(block))
+      s = (top - low) / _max_count
+      block = (block - low[:, None]) / np.where(s > 0, s, 1)[:, None]
+      counts[start:start+len(block)] = np.clip(np.rint(block), 0, _max_count)
+      scale[start:start+len(block)] = s
+      offset[start:start+len(block)] = low
+    return cls(counts, scale, offset)
+
+  @property
+  def shape(self):
+    return self.counts.shape
+
+  @property
+  def ndim(self):
+    return 2
+
+  @property
+  def nbytes(self):
+    return self.counts.nbytes + self.scale.nbytes + self.offset.nbytes
+
+  def __len__(self):
+    return len(self.counts)
+
+  def __getitem__(self, key):
+    rows = key[0] if isinstance(key, tuple) else key
+    counts = self.counts[key]
+    scale, offset = self.scale[rows], self.offset[rows]
+    if np.ndim(scale) == 1 and np.ndim(counts) == 2:
+      scale, offset = scale[:, None], offset[:, None]
+    return counts.astype(np.float32) * scale + offset
+
+  def __iter__(self):
+    for start in range(0, len(self), 4096):
+      for row in self[start:start+4096]:
+        yield row
+
+  def __array__(self, dtype=None, copy=None):
+    hist = self[:]
+    return hist if dtype is None else hist.astype(dtype)
+
+
+def encode(hist, precision=default_precision):
+  ''' hist stored with precision, a numpy array or a QuantizedMatrix for uint16 '''
+  assert precision in precisions, "precision %s isn't supported!" % precision
+  if precision == 'uint16':
+    return hist if isinstance(hist, QuantizedMatrix) else QuantizedMatrix.encode(hist)
+  return np.ascontiguousarray(np.asarray(hist), dtype=precisions[precision])
+
+
+def precision_of(hist):
+  ''' name of the precision hist is stored with '''
+  if isinstance(hist, QuantizedMatrix):
+    return 'uint16'
+  return np.dtype(hist.dtype).name
+
+
+def benchmark(store, path, precisions=tuple(precisions), depths=(None,), d_type='d1', verbose=True):
+  ''' compare the size, speed and retrieval quality of a store saved with each precision
+
+    every precision is saved at path/<precision> and memory-mapped back, then all its samples
+    are inferred against each other with evaluate_all_pairs
+
+    arguments
+      store     : a FeatureStore extracted with precision='float64', the reference of max_error
+      path      : directory the stores are written to
+      precisions: precisions to compare
+      depths    : retrieved depths
+      d_type    : distance type
+
+    return
+      a dict {precision: {'bytes', 'seconds', 'MMAP': {depth: MMAP}, 'max_error'}}, max_error being
+      the largest absolute difference with the float64 features
+  '''
+  from feature_store import FeatureStore
+  from evaluate import SampleIndex, evaluate_all_pairs
+
+  assert store.precision == 'float64', "the reference store needs to be extracted with precision='float64'!"
+  reference = np.asarray(store.hist, dtype=np.float64)
+  report = {}
+  for precision in precisions:
+    stored = FeatureStore(encode(store.hist, precision), store.img, store.cls_id, store.classes)
+    stored.save(os.path.join(path, precision))
+    loaded = FeatureStore.load(os.path.join(path, precision))
+
+    start = time.time()
+    APs = evaluate_all_pairs(SampleIndex(loaded), depths=depths, d_type=d_type)
+    seconds = time.time() - start
+
+    max_error = 0.
+    for row in range(0, len(loaded), 4096):
+      error = np.absolute(np.asarray(loaded.hist[row:row+4096], dtype=np.float64) - reference[row:row+4096])
+      max_error = max(max_error, float(error.max()) if error.size else 0.)
+    report[precision] = {
+      'bytes': loaded.hist.nbytes,
+      'seconds': seconds,
+      'MMAP': {d: float(np.mean([np.mean(aps) for aps in APs[d].values()])) for d in depths},
+      'max_error': max_error,
+    }
+    if verbose:
+      print("{:8s} {:8.2f} MB {:7.2f} s max error {:.2e} ".format(
+            precision, report[precision]['bytes'] / 2.**20, seconds, max_error)
+            + ' '.join("depth{} MMAP {:.6f}".format(d, m) for d, m in report[precision]['MMAP'].items()))
+  return report
+
+
+if __name__ == "__main__":
+  from database import Database
+  from color import Color
+
+  db = Database('database/train')
+  store = Color().make_samples(db, precision='float64').store
+  benchmark(store, os.path.join('cache', 'precision-benchmark'), depths=(None, 10))
@@ -2,19 +2,14 @@
 
 from __future__ import print_function
 
-from evaluate import evaluate_class
+from evaluate import evaluate_class, evaluate_class_depths
 from database import Database
-
-from color import Color
-from daisy import Daisy
-from edge  import Edge
-from gabor import Gabor
-from HOG   import HOG
-from vggnet import VGGNetFeat
-from resnet import ResNetFeat
+from feature_store import FeatureStore, join_stores
+from registry import FeatureRegistry, get_extractor
 
 from sklearn.random_projection import johnson_lindenstrauss_min_dim
 from sklearn import random_projection
+from scipy import sparse
 import numpy as np
 import itertools
 import os
@@ -24,137 +19,224 @@ feat_pools = ['color', 'daisy', 'edge', 'gabor', 'hog', 'vgg', 'res']
 
 keep_rate = 0.25
 project_type = 'sparse'
+random_state = 0  # seed of the projection matrix
+
+# fitted projections, keyed by (n_samples, n_dims, keep_rate, project_type, random_state)
+_projections = {}
 
 # result dir
 result_dir = 'result'
 if not os.path.exists(result_dir):
   os.makedirs(result_dir)
 
+# cache dir, fitted projections are saved there
+cache_dir = 'cache'
+if not os.path.exists(cache_dir):
+  os.makedirs(cache_dir)
+
+
+class Projector(object):
+  ''' a fitted random projection, saved to disk to project queries into the same space
+
+    arguments
+      components: projection matrix with shape (n_components, n_dims), a scipy CSR matrix
+                  for the 'sparse' projection or a numpy array for the 'gaussian' one
+  '''
+
+  def __init__(self, components):
+    self.components = components
+
+  @classmethod
+  def fit(cls, n_samples, n_dims, eps, project_type=project_type, random_state=random_state):
+    n_components = johnson_lindenstrauss_min_dim(n_samples=n_samples, eps=eps)
+    if project_type == 'gaussian':
+      transformer = random_projection.GaussianRandomProjection(n_components=n_components, random_state=random_state)
+    elif project_type == 'sparse':
+      transformer = random_projection.SparseRandomProjection(n_components=n_components, random_state=random_state)
+    # the projection only depends on the data shape, a single row of that width is enough
+    transformer.fit(np.zeros((1, n_dims)))
+    components = transformer.components_
+    if sparse.issparse(components):
+      return cls(sparse.csr_matrix(components, dtype=np.float32))
+    return cls(np.asarray(components, dtype=np.float32))
+
+  @classmethod
+  def exists(cls, path):
+    return os.path.isfile(os.path.join(path, 'components.npz')) or os.path.isfile(os.path.join(path, 'components.npy'))
+
+  @classmethod
+  def load(cls, path):
+    if os.path.isfile(os.path.join(path, 'components.npz')):
+      return cls(sparse.load_npz(os.path.join(path, 'components.npz')).tocsr())
+    return cls(np.load(os.path.join(path, 'components.npy')))
+
+  def save(self, path):
+    if not os.path.exists(path):
+      os.makedirs(path)
+    if sparse.issparse(self.components):
+      sparse.save_npz(os.path.join(path, 'components.npz'), self.components)
+    else:
+      np.save(os.path.join(path, 'components.npy'), self.components)
+
+  @property
+  def n_components(self):
+    return self.components.shape[0]
+
+  def transform(self, feats, batch_size=4096):
+    ''' project a single histogram or a matrix of them, by blocks of batch_size rows '''
+    if not hasattr(feats, 'shape'):
+      feats = np.asarray(feats, dtype=np.float32)
+    if feats.ndim == 1:
+      return self.transform(feats[None, :])[0]
+    out = np.empty((feats.shape[0], self.n_components), dtype=np.float32)
+    for start in range(0, feats.shape[0], batch_size):
+      # blocks of stores saved with less precision are decoded one at a time
+      block = np.asarray(feats[start:start+batch_size], dtype=np.float32)
+      out[start:start+len(block)] = np.asarray(self.components.dot(block.T)).T
+    return out
+
+  def transform_store(self, store, path, batch_size=4096):
+    ''' project a FeatureStore into a new one saved at path, without loading it in memory '''
+    return store.transform(path, self.transform, batch_size=batch_size)
+
 
 class RandomProjection(object):
 
-  def __init__(self, features, keep_rate=keep_rate, project_type=project_type):
+  def __init__(self, features, keep_rate=keep_rate, project_type=project_type, registry=None, random_state=random_state):
     assert len(features) > 0, "need to give at least one feature!"
     self.features     = features
     self.keep_rate    = keep_rate
     self.project_type = project_type
+    self.registry     = registry  # a FeatureRegistry holding the features, loaded from caches if None
+    self.random_state = random_state
 
     self.samples      = None
+    self.dropped      = []
+    self.projected    = False  # whether the samples could be projected
+    self.projector    = None  # Projector fitted by make_samples
 
   def make_samples(self, db, verbose=False):
     if verbose:
       print("Use features {}, {} RandomProject, keep {}".format(" & ".join(self.features), self.project_type, self.keep_rate))
 
     if self.samples == None:
-      feats = []
-      for f_class in self.features:
-        feats.append(self._get_feat(db, f_class))
-      samples = self._concat_feat(db, feats)
-      samples, _ = self._rp(samples)
+      samples = self._get_samples(db)
+      samples, self.projected = self._rp(samples)
       self.samples = samples  # cache the result
     return self.samples
 
-  def check_random_projection(self):
+  def check_random_projection(self, db):
     ''' check if current smaple can fit to random project
 
        return
          a boolean
     '''
     if self.samples == None:
-      feats = []
-      for f_class in self.features:
-        feats.append(self._get_feat(db, f_class))
-      samples = self._concat_feat(db, feats)
-      samples, flag = self._rp(samples)
+      samples = self._get_samples(db)
+      samples, self.projected = self._rp(samples)
       self.samples = samples  # cache the result
-    return True if flag else False
+    return self.projected
+
+  def _get_samples(self, db):
+    if self.registry is not None:
+      return self._report_dropped(*self.registry.join(self.features))
+    feats = []
+    for f_class in self.features:
+      feats.append(self._get_feat(db, f_class))
+    return self._concat_feat(db, feats)
 
   def _get_feat(self, db, f_class):
-    if f_class == 'color':
-      f_c = Color()
-    elif f_class == 'daisy':
-      f_c = Daisy()
-    elif f_class == 'edge':
-      f_c = Edge()
-    elif f_class == 'gabor':
-      f_c = Gabor()
-    elif f_class == 'hog':
-      f_c = HOG()
-    elif f_class == 'vgg':
-      f_c = VGGNetFeat()
-    elif f_class == 'res':
-      f_c = ResNetFeat()
-    return f_c.make_samples(db, verbose=False)
+    return get_extractor(f_class).make_samples(db, verbose=False)
 
   def _concat_feat(self, db, feats):
-    samples = feats[0]
-    delete_idx = []
-    for idx in range(len(samples)):
-      for feat in feats[1:]:
-        feat = self._to_dict(feat)
-        key = samples[idx]['img']
-        if key not in feat:
-          delete_idx.append(idx)
-          continue
-        assert feat[key]['cls'] == samples[idx]['cls']
-        samples[idx]['hist'] = np.append(samples[idx]['hist'], feat[key]['hist'])
-    for d_idx in sorted(set(delete_idx), reverse=True):
-      del samples[d_idx]
-    if delete_idx != []:
-      print("Ignore %d samples" % len(set(delete_idx)))
-
-    return samples
-
-  def _to_dict(self, feat):
-    ret = {}
-    for f in feat:
-      ret[f['img']] = {
-        'cls': f['cls'],
-        'hist': f['hist']
-      }
-    return ret
+    stores = [FeatureStore.from_samples(feat) for feat in feats]
+    return self._report_dropped(*join_stores(stores))
+
+  def _report_dropped(self, store, dropped):
+    if dropped:
+      print("Ignore %d samples" % len(dropped))
+    self.dropped = dropped  # image paths missing from at least one feature
+    return store.as_samples()
 
   def _rp(self, samples):
-    feats = np.array([s['hist'] for s in samples])
-    eps = self._get_eps(n_samples=feats.shape[0], n_dims=feats.shape[1])
-    if eps == -1:
+    store = FeatureStore.from_samples(samples)
+    feats = store.hist
+    projector = self._get_projector(feats)
+    if projector is None:
       import warnings
       warnings.warn(
         "Can't fit to random projection with keep_rate {}\n".format(self.keep_rate), RuntimeWarning
       )
       return samples, False
-    if self.project_type == 'gaussian':
-      transformer = random_projection.GaussianRandomProjection(eps=eps) 
-    elif self.project_type == 'sparse':
-      transformer = random_projection.SparseRandomProjection(eps=eps)
-    feats = transformer.fit_transform(feats)
+    self.projector = projector
+    feats = projector.transform(feats)
     assert feats.shape[0] == len(samples)
-    for idx in range(len(samples)):
-      samples[idx]['hist'] = feats[idx]
-    return samples, True
+    store = FeatureStore(feats, store.img, store.cls_id, store.classes)
+    return store.as_samples(), True
 
-  def _get_eps(self, n_samples, n_dims, n_slice=int(1e4)):
-    new_dim = n_dims * self.keep_rate
-    for i in range(1, n_slice):
-      eps = i / n_slice
-      jl_dim = johnson_lindenstrauss_min_dim(n_samples=n_samples, eps=eps)
-      if jl_dim <= new_dim:
-        print("rate %.3f, n_dims %d, new_dim %d, dims error rate: %.4f" % (self.keep_rate, n_dims, jl_dim, ((new_dim-jl_dim) / new_dim)) )
-        return eps
-    return -1
+  def project(self, hist):
+    ''' project a query histogram, or a matrix of them, into the space of the samples '''
+    assert self.projector is not None, "make_samples needs to be called first!"
+    return self.projector.transform(hist)
+
+  def _get_projector(self, feats):
+    ''' fitted projection for feats, shared by every instance with the same settings
+
+      a random projection only depends on the data shape, so it is fitted once per shape
+      and saved in cache_dir, later runs load it back instead of drawing a new matrix
+
+      return
+        a Projector, or None if keep_rate is too low for the JL bound
+    '''
+    n_samples, n_dims = feats.shape
+    key = (n_samples, n_dims, self.keep_rate, self.project_type, self.random_state)
+    if key not in _projections:
+      path = os.path.join(cache_dir, "projection-{}-keep{}-seed{}-n{}-d{}".format(
+        self.project_type, self.keep_rate, self.random_state, n_samples, n_dims))
+      if Projector.exists(path):
+        projector = Projector.load(path)
+      else:
+        eps = self._get_eps(n_samples=n_samples, n_dims=n_dims)
+        projector = None
+        if eps != -1:
+          projector = Projector.fit(n_samples, n_dims, eps, project_type=self.project_type, random_state=self.random_state)
+          projector.save(path)
+      _projections[key] = projector
+    return _projections[key]
 
+  def _get_eps(self, n_samples, n_dims, n_slice=int(1e4)):
+    ''' smallest eps among i / n_slice whose JL dimension fits in n_dims * keep_rate, -1 if none
 
-def evaluate_feats(db, N, feat_pools=feat_pools, keep_rate=keep_rate, project_type=project_type, d_type='d1', depths=[None, 300, 200, 100, 50, 30, 10, 5, 3, 1]):
+      the JL dimension decreases with eps, so the grid is searched by bisection
+    '''
+    new_dim = n_dims * self.keep_rate
+    jl = lambda i: johnson_lindenstrauss_min_dim(n_samples=n_samples, eps=i / n_slice)
+    lo, hi = 1, n_slice - 1
+    if hi < lo or jl(hi) > new_dim:
+      return -1
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if jl(mid) <= new_dim:
+        hi = mid
+      else:
+        lo = mid + 1
+    jl_dim = jl(lo)
+    print("rate %.3f, n_dims %d, new_dim %d, dims error rate: %.4f" % (self.keep_rate, n_dims, jl_dim, ((new_dim-jl_dim) / new_dim)) )
+    return lo / n_slice
+
+
+def evaluate_feats(db, N, feat_pools=feat_pools, keep_rate=keep_rate, project_type=project_type, d_type='d1', depths=[None, 300, 200, 100, 50, 30, 10, 5, 3, 1], registry=None):
   result = open(os.path.join(result_dir, 'feature_reduction-{}-keep{}-{}-{}feats.csv'.format(project_type, keep_rate, d_type, N)), 'w')
   for i in range(N):
     result.write("feat{},".format(i))
   result.write("depth,distance,MMAP")
   combinations = itertools.combinations(feat_pools, N)
   for combination in combinations:
-    fusion = RandomProjection(features=list(combination), keep_rate=keep_rate, project_type=project_type)
-    if fusion.check_random_projection():
+    fusion = RandomProjection(features=list(combination), keep_rate=keep_rate, project_type=project_type, registry=registry)
+    if fusion.check_random_projection(db):
+      depth_APs = evaluate_class_depths(db, f_instance=fusion, d_type=d_type, depths=depths)
       for d in depths:
-        APs = evaluate_class(db, f_instance=fusion, d_type=d_type, depth=d)
+        APs = depth_APs[d]
         cls_MAPs = []
         for cls, cls_APs in APs.items():
           MAP = np.mean(cls_APs)
@@ -166,34 +248,25 @@ def evaluate_feats(db, N, feat_pools=feat_pools, keep_rate=keep_rate, project_ty
   result.close()
 
 
-if __name__ == "__main__":
-  db = Database()
-
-  # evaluate features single-wise
-  evaluate_feats(db, N=1, d_type='d1', keep_rate=keep_rate, project_type=project_type)
+def evaluate_sweep(db, sizes, feat_pools=feat_pools, keep_rate=keep_rate, project_type=project_type, d_type='d1', depths=[None, 300, 200, 100, 50, 30, 10, 5, 3, 1]):
+  ''' evaluate_feats for every combination size in sizes, each feature being loaded only once '''
+  registry = FeatureRegistry(db, feat_pools)
+  for N in sizes:
+    evaluate_feats(db, N, feat_pools=feat_pools, keep_rate=keep_rate, project_type=project_type,
+                   d_type=d_type, depths=depths, registry=registry)
+  return registry
 
-  # evaluate features double-wise
-  evaluate_feats(db, N=2, d_type='d1', keep_rate=keep_rate, project_type=project_type)
 
-  # evaluate features triple-wise
-  evaluate_feats(db, N=3, d_type='d1', keep_rate=keep_rate, project_type=project_type)
-  
-  # evaluate features quadra-wise
-  evaluate_feats(db, N=4, d_type='d1', keep_rate=keep_rate, project_type=project_type)
-
-  # evaluate features penta-wise
-  evaluate_feats(db, N=5, d_type='d1', keep_rate=keep_rate, project_type=project_type)
-
-  # evaluate features hexa-wise
-  evaluate_feats(db, N=6, d_type='d1', keep_rate=keep_rate, project_type=project_type)
+if __name__ == "__main__":
+  db = Database()
 
-  # evaluate features hepta-wise
-  evaluate_feats(db, N=7, d_type='d1', keep_rate=keep_rate, project_type=project_type)
+  # evaluate features single-wise up to hepta-wise
+  registry = evaluate_sweep(db, sizes=range(1, 8), d_type='d1', keep_rate=keep_rate, project_type=project_type)
   
   # evaluate color feature
   d_type = 'd1'
   depth  = 30
-  fusion = RandomProjection(features=['color'], keep_rate=keep_rate, project_type=project_type)
+  fusion = RandomProjection(features=['color'], keep_rate=keep_rate, project_type=project_type, registry=registry)
   APs = evaluate_class(db, f_instance=fusion, d_type=d_type, depth=depth)
   cls_MAPs = []
   for cls, cls_APs in APs.items():
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from feature_store import FeatureStore, join_stores
+from extraction import extract_stores
+
+import importlib
+
+
+# module and class implementing each feature, imported on first use
+extractors = {
+  'color': ('color',  'Color'),
+  'daisy': ('daisy',  'Daisy'),
+  'edge':  ('edge',   'Edge'),
+  'gabor': ('gabor',  'Gabor'),
+  'hog':   ('HOG',    'HOG'),
+  'vgg':   ('vggnet', 'VGGNetFeat'),
+  'res':   ('resnet', 'ResNetFeat'),
+}
+
+
+def get_extractor(name):
+  ''' return an instance of the feature class registered as name '''
+  module, class_name = extractors[name]
+  return getattr(importlib.import_module(module), class_name)()
+
+
+class FeatureRegistry(object):
+  ''' features of a database, loaded once and shared by every combination of them
+
+    the samples of each feature are made a single time, in one pass over the images for the
+    features backed by a FeatureCache; a combination is aligned on the images common to its
+    features only, and its matrix is a feature_store.JoinedMatrix reading the columns of each
+    feature store, so that no combination copies the features
+
+    arguments
+      db      : an instance of class Database
+      features: names of the features to load, keys of extractors
+  '''
+
+  def __init__(self, db, features, verbose=True):
+    self.features = list(features)
+    extractors = [get_extractor(name) for name in self.features]
+
+    # features with a FeatureCache are extracted together, decoding every image once
+    shared = [k for k, e in enumerate(extractors) if hasattr(e, 'feature_cache')]
+    stores = [None] * len(extractors)
+    if shared:
+      if verbose:
+        print("Loading features %s" % ", ".join(self.features[k] for k in shared))
+      for k, store in zip(shared, extract_stores([extractors[k] for k in shared], db, verbose=False)):
+        stores[k] = store
+    for k, name in enumerate(self.features):
+      if stores[k] is None:
+        if verbose:
+          print("Loading feature %s" % name)
+        stores[k] = FeatureStore.from_samples(extractors[k].make_samples(db, verbose=False))
+    self.stores = dict(zip(self.features, stores))
+
+  def join(self, features):
+    ''' (FeatureStore of the concatenation of features, image paths missing from some of them)
+
+      a single feature is served as its own store, several as a JoinedMatrix over their stores
+    '''
+    return join_stores([self.stores[name] for name in features], copy=False)
+
+  def select(self, features):
+    ''' FeatureStore of the concatenation of features, see join '''
+    return self.join(features)[0]
+
+  def make_samples(self, features):
+    return self.select(features).as_samples()
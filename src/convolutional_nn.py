@@ -1,4 +1,7 @@
-import shutil, os
+import os, csv, sys, time
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.metrics import ConfusionMatrixDisplay, confusion_matrix
 
@@ -6,10 +9,90 @@ from tensorflow import argmax
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Conv2D, MaxPooling2D
 from tensorflow.keras.layers import Activation, Dropout, Flatten, Dense
+from tensorflow.keras.preprocessing.image import load_img, img_to_array
 
 from .database import Database
 
 
+class PredictionWriter:
+    """
+    Write predictions to a single columnar file, batch after batch.
+
+    Columns are path, true_class (empty when unknown), predicted_class and one
+    p_<classe> column per class with its probability. The format follows the
+    extension of the file: '.parquet' (needs pyarrow) or CSV otherwise.
+    """
+    def __init__(self, filename, classes):
+        self.filename = filename
+        self.classes = list(classes)
+        self.columns = ['path', 'true_class', 'predicted_class'] + ['p_' + classe for classe in self.classes]
+        self.parquet = filename.endswith('.parquet')
+        self.n_rows = 0
+
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        if self.parquet:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("Writing {} needs pyarrow (pip install pyarrow), "
+                                  "or use a .csv output".format(filename))
+            self._pa = pa
+            self.schema = pa.schema(
+                [(name, pa.string()) for name in self.columns[:3]] +
+                [(name, pa.float32()) for name in self.columns[3:]]
+            )
+            self._writer = pq.ParquetWriter(filename, self.schema)
+        else:
+            self._file = open(filename, 'w', encoding='UTF-8', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(self.columns)
+
+    def write(self, paths, probabilities, true_classes=None):
+        """
+        Append the predictions of a batch.
+
+        Parameters:
+            - paths: paths of the images.
+            - probabilities: array of shape (len(paths), len(classes)).
+            - true_classes: names of the true classes, if known.
+
+        Returns:
+            - the predicted class names.
+        """
+        probabilities = np.asarray(probabilities, dtype=np.float32).reshape(len(paths), len(self.classes))
+        predicted = [self.classes[k] for k in np.argmax(probabilities, axis=1)]
+        true_classes = list(true_classes) if true_classes is not None else [''] * len(paths)
+
+        if self.parquet:
+            columns = [self._pa.array(list(paths)), self._pa.array(true_classes), self._pa.array(predicted)]
+            columns += [self._pa.array(probabilities[:, k]) for k in range(len(self.classes))]
+            self._writer.write_table(self._pa.Table.from_arrays(columns, schema=self.schema))
+        else:
+            for k, path in enumerate(paths):
+                self._writer.writerow(
+                    [path, true_classes[k], predicted[k]] + ['{:.6g}'.format(p) for p in probabilities[k]]
+                )
+            self._file.flush()
+
+        self.n_rows += len(paths)
+        return predicted
+
+    def close(self):
+        if self.parquet:
+            self._writer.close()
+        else:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class CNNClassifier(Sequential):
     """
     Simple convolutional network classifier with methods to interract
@@ -58,7 +141,7 @@ class CNNClassifier(Sequential):
         plt.legend(history.history.keys(), loc='upper left')
         plt.show()
 
-    def train(self, database, batch_size=16, epochs=15, history=False, overwrite=False):
+    def train(self, database, batch_size=16, epochs=15, history=False, overwrite=False, backend='keras', cache=None):
         """
         Train model on test subfolder of database
 
@@ -66,6 +149,9 @@ class CNNClassifier(Sequential):
             - database: database object defined in this library.
             - overwrite: allow to overwrite existing training data.
             - history: if set to true, plot the evolution of metrics over epochs.
+            - backend: image loader, 'keras' (ImageDataGenerator) or 'tf.data'.
+            - cache: with the tf.data backend, '' keeps decoded images in memory
+                and a filename keeps them on disk, see Database.get_images_dataset.
         """
 
         # si le modele a deja ete entraine, charge les poids existants
@@ -75,8 +161,15 @@ class CNNClassifier(Sequential):
             print('Weights already existing, skipping training step.')
             return
         
-        train_images = database.get_images_generator('train')
-        validation_images = database.get_images_generator('validation')
+        loader = {'batch_size': batch_size, 'target_size': self.target_size}
+        if backend == 'tf.data':
+            train_cache = cache and cache + '_train'
+            validation_cache = cache and cache + '_validation'
+            train_images = database.get_images('train', backend, cache=train_cache, **loader)
+            validation_images = database.get_images('validation', backend, cache=validation_cache, **loader)
+        else:
+            train_images = database.get_images('train', backend, **loader)
+            validation_images = database.get_images('validation', backend, **loader)
 
         # entraine le modele en utilisant les images de train et validation
         train_history = self.fit(
@@ -92,48 +185,140 @@ class CNNClassifier(Sequential):
             self.plot_history(train_history)
         
 
-    def classify_test_images(self, database, confusion_matrix=False, separate_miss=True):
+    def classify_test_images(self, database, confusion_matrix=False, separate_miss=True, output=None,
+                             folders=None):
         """
         Use trained model to predict classes of images in test/ folder.
-        Output theses images in a folder called predictions/
+        Write the predictions to a single file, and optionally output theses
+        images in folders results/<classe predite>/.
         Parameter:
             - database: neural_network.Database object.
-            - separate_miss: if true, create a miss folder to store failed predictions.
+            - separate_miss: if true, create a miss folder to store failed predictions (needs folders).
             - confusion_matrix: if true, plot a confusion matrix showing classfication accuracy.
+            - output: predictions file, see PredictionWriter, defaults to <database>/predictions.csv.
+            - folders: None to only write the predictions file, or 'hardlink', 'symlink'
+                or 'copy' to also fill the results/ (and miss/) folders, see Database.materialize.
+
+        Returns:
+            - the path of the predictions file.
         """
+        output = output or os.path.join(database.path, 'predictions.csv')
 
         # charge la liste des images dans le jeu de test et leurs labels
-        test_images = database.get_images_generator('test', shuffle=False)
-
-        # cree un (ou deux) repertoire(s) vides pour stocker les predictions de la classification
-        database.reset_output(miss=separate_miss)
+        test_images = database.get_images_generator('test', shuffle=False, target_size=self.target_size)
 
-        # predit les labels des images du jeu de test
-        predictions = argmax(self.predict(test_images), axis=1).numpy()
+        # predit les labels des images du jeu de test
+        probabilities = self.predict(test_images)
+        predictions = argmax(probabilities, axis=1).numpy()
         classes = database.classes
+        # les images sont predites dans l'ordre du generateur (pas de melange)
+        paths, labels = list(test_images.filepaths), test_images.classes
 
-        for k in range(len(predictions)):
-            classe = classes[predictions[k]]
-            true_classe, filename = test_images.filenames[k].split('/')
+        with PredictionWriter(output, classes) as writer:
+            writer.write(paths, probabilities, true_classes=[classes[label] for label in labels])
 
-            # copie toutes images dans le repertoire results/<classe predite>
-            shutil.copy(
-                os.path.join(database.path, 'test', test_images.filenames[k]),
-                os.path.join(database.path, 'results', classe, filename)
-            )
-            if separate_miss and true_classe != classe:
-                # copie les echecs de predictions dans le rep. miss/<classe predite>
-                # permet d'analyser les faux positifs
-                shutil.copy(
-                    os.path.join(database.path, 'test', test_images.filenames[k]),
-                    os.path.join(database.path, 'miss', classe, filename)
+        if folders:
+            # cree un (ou deux) repertoire(s) vides pour stocker les predictions de la classification
+            database.reset_output(miss=separate_miss)
+
+            for k in range(len(predictions)):
+                classe = classes[predictions[k]]
+                true_classe, filename = classes[labels[k]], os.path.basename(paths[k])
+
+                # lie toutes images dans le repertoire results/<classe predite>
+                Database.materialize(
+                    paths[k],
+                    os.path.join(database.path, 'results', classe, filename),
+                    folders
                 )
+                if separate_miss and true_classe != classe:
+                    # lie les echecs de predictions dans le rep. miss/<classe predite>
+                    # permet d'analyser les faux positifs
+                    Database.materialize(
+                        paths[k],
+                        os.path.join(database.path, 'miss', classe, filename),
+                        folders
+                    )
 
         # si demande, affiche la matrice de confusion des predictions
         if confusion_matrix:
-            self.confusion_matrix(test_images.classes, predictions, labels=database.classes)
+            self.confusion_matrix(labels, predictions, labels=database.classes)
+
+        return output
         
         
+    def _load_image(self, path):
+        """
+        Return an image resized to the model input and rescaled, or None if it can't be read.
+        """
+        try:
+            return img_to_array(load_img(path, target_size=self.target_size)) / 255.
+        except (OSError, ValueError) as error:
+            print('\nSkipping {}: {}'.format(path, error), file=sys.stderr)
+            return None
+
+    def predict_paths(self, paths, output, classes, batch_size=64, n_threads=4, verbose=True):
+        """
+        Predict the classes of images given by path, batch after batch.
+
+        The next batch is decoded on a thread pool while the current one is
+        predicted, and predictions are appended to the output file after each
+        batch, so memory doesn't grow with the number of images. Unreadable
+        images are skipped.
+
+        Parameters:
+            - paths: iterable of image paths, e.g. database.iter_image_paths.
+            - output: predictions file, see PredictionWriter.
+            - classes: class names of the model outputs, e.g. database.classes.
+            - batch_size: number of images per batch.
+            - n_threads: number of decoding threads.
+            - verbose: print the throughput while predicting.
+
+        Returns:
+            - a dict with the number of images predicted and skipped, the time and images/sec.
+        """
+        paths = iter(paths)
+        n_skipped = 0
+        start = time.perf_counter()
+
+        with PredictionWriter(output, classes) as writer, ThreadPoolExecutor(max_workers=max(1, n_threads)) as pool:
+            def submit():
+                batch = list(islice(paths, batch_size))
+                return batch, [pool.submit(self._load_image, path) for path in batch]
+
+            batch, futures = submit()
+            while batch:
+                images = [future.result() for future in futures]
+                # lance le decodage du lot suivant pendant la prediction de celui-ci
+                next_batch, next_futures = submit()
+
+                readable = [k for k, image in enumerate(images) if image is not None]
+                n_skipped += len(images) - len(readable)
+                if readable:
+                    probabilities = self.predict_on_batch(np.stack([images[k] for k in readable]))
+                    writer.write([batch[k] for k in readable], np.asarray(probabilities))
+
+                if verbose:
+                    elapsed = time.perf_counter() - start
+                    sys.stdout.write('\rPredicted {} images, {:.1f} images/sec'.format(
+                        writer.n_rows, writer.n_rows / elapsed if elapsed else 0.))
+                    sys.stdout.flush()
+                batch, futures = next_batch, next_futures
+
+            n_images = writer.n_rows
+
+        elapsed = time.perf_counter() - start
+        stats = {
+            'images': n_images,
+            'skipped': n_skipped,
+            'seconds': elapsed,
+            'images_per_second': n_images / elapsed if elapsed else 0.
+        }
+        if verbose:
+            print('\nPredicted {images} images ({skipped} skipped) in {seconds:.1f}s, '
+                  '{images_per_second:.1f} images/sec'.format(**stats))
+        return stats
+
     def confusion_matrix(self, y_true, y_pred, labels=None):
         """
         Plot confusion matrix using matplotlib and sklearn.
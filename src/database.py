@@ -1,8 +1,26 @@
 
 import os
+import csv
+import json
 import shutil
-from random import randint, random
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
+from random import Random
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras.preprocessing.image import ImageDataGenerator, load_img, img_to_array
+from tensorflow.keras.utils import Sequence
+
+
+# extensions of the images read by both loaders, the ones of flow_from_directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.ppm', '.tif', '.tiff')
+# extensions tf.io.decode_image can't read, get_images_dataset decodes them with PIL
+PIL_EXTENSIONS = ('.ppm', '.tif', '.tiff')
+# number of decoded images get_images_dataset shuffles from when they are cached
+SHUFFLE_BUFFER = 1024
+# number of images per shard written by Database.prepare
+SHARD_SIZE = 4096
+# ways Database.create materializes the images of a split
+CREATE_MODES = ('copy', 'hardlink', 'symlink', 'manifest')
 
 
 class Database:
@@ -11,6 +29,7 @@ class Database:
     """
     def __init__(self, database_path):
         self.path = database_path
+        self._manifest = None
 
     @classmethod
     def _generate_labels_file(cls, database_path, subfolder):
@@ -39,16 +58,38 @@ class Database:
                     f.write("\n{},{}".format(img, classe))
     
     @classmethod
-    def random_classes(cls, from_folder):
+    def random_classes(cls, from_folder, rng=None):
         """
         Return a set of 2-8 classes randomly picked in <from_folder>.
+
+        Parameters:
+            - rng: random.Random instance, a seeded one picks the same classes every time.
         """
-        n = randint(2, 8)
+        rng = rng or Random()
+        n = rng.randint(2, 8)
         # recupere la liste de toutes les classes dans un ordre aleatoire
-        all_classes = sorted(os.listdir(from_folder), key=lambda x: random())
+        all_classes = sorted(os.listdir(from_folder))
+        rng.shuffle(all_classes)
         # renvoie les n premiers resultats
         return all_classes[:n]
 
+    @classmethod
+    def materialize(cls, source, destination, mode):
+        """
+        Make the image <source> available at <destination> according to mode.
+        """
+        if mode == 'hardlink':
+            try:
+                os.link(source, destination)
+                return
+            except OSError:
+                # les liens physiques ne traversent pas les systemes de fichiers
+                pass
+        elif mode == 'symlink':
+            os.symlink(os.path.abspath(source), destination)
+            return
+        shutil.copy(source, destination)
+
 
     def reset_output(self, miss=False):
         """
@@ -66,7 +107,8 @@ class Database:
                 os.makedirs(os.path.join(folder, classe))
 
     @classmethod
-    def create(cls, database_name, from_folder, classes=None, ratios=(0.7, 0.15, 0.15), csv_labels=True):
+    def create(cls, database_name, from_folder, classes=None, ratios=(0.7, 0.15, 0.15), csv_labels=True,
+               prepare=False, target_size=(150, 150), mode='copy', seed=None):
         """
         Create a new database with train, validation and test subfolders.
 
@@ -76,49 +118,196 @@ class Database:
             - ratios: proportion of respectively train, validation and test subsets.
             - classes: list of classes that will be extracted from original folder
                 if not specified, a set of 2-8 classes will be randomly picked.
+            - prepare: if true, also write the resized images in shards, see prepare.
+            - target_size: A tuple (height, width) of the images in the shards.
+            - mode: how images are put in the database
+                'copy' copies them, 'hardlink' and 'symlink' link them to the source
+                (hard links fall back to copies across file systems), and 'manifest'
+                only writes manifest.csv listing the split, class and source path
+                of every image, which the loaders read directly.
+            - seed: seed of the split, the same seed and source give the same database.
         """
         assert sum(ratios) == 1, "Sum of ratios must be equal to 1!"
+        assert mode in CREATE_MODES, "mode must be one of {}!".format(CREATE_MODES)
+        rng = Random(seed)
 
         # supprime une base de données de même nom qui pourrait exister
         shutil.rmtree(database_name, ignore_errors=True)
 
         # si aucune classe n'est passée en paramètre, en choisi aléatoirement
         if not classes:
-            classes = cls.random_classes(from_folder)
+            classes = cls.random_classes(from_folder, rng)
         
+        manifest = []
         for classe in classes:
             origin_class_path = os.path.join(from_folder, classe)
-            # recupere la liste des images de cette classe dans un ordre aleatoire
-            class_images = sorted(os.listdir(origin_class_path), key=lambda x: random())
+            # recupere la liste des images de cette classe dans un ordre aleatoire
+            # (triee d'abord, l'ordre de os.listdir depend du systeme de fichiers)
+            class_images = sorted(os.listdir(origin_class_path))
+            rng.shuffle(class_images)
             # 
             n = len(class_images)
             slices = (0, int(n*ratios[0]), int(n*(ratios[0]+ratios[1])), n)
 
             subfolders = ('train', 'validation', 'test')
             for k in range(3):
+                images = class_images[slices[k]: slices[k+1]]
+                if mode == 'manifest':
+                    manifest.extend((subfolders[k], classe, os.path.abspath(os.path.join(origin_class_path, image)))
+                                    for image in images)
+                    continue
                 # crée au fur et a mesure l'arborescence de la nouvelle base de données
                 dest_folder = os.path.join(database_name, subfolders[k], classe)
                 os.makedirs(dest_folder)
-                # copie un sous ensemble des images dans le repertoire
-                for image in class_images[slices[k]: slices[k+1]]:
-                    shutil.copy(
+                # copie (ou lie) un sous ensemble des images dans le repertoire
+                for image in images:
+                    cls.materialize(
                         os.path.join(origin_class_path, image),
-                        os.path.join(dest_folder, image)
+                        os.path.join(dest_folder, image),
+                        mode
                     )
 
-        if csv_labels:
+        if mode == 'manifest':
+            os.makedirs(database_name)
+            with open(os.path.join(database_name, 'manifest.csv'), 'w', encoding='UTF-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(('split', 'cls', 'path'))
+                writer.writerows(manifest)
+
+        elif csv_labels:
             cls._generate_labels_file(database_name, 'train')
             cls._generate_labels_file(database_name, 'validation')
             cls._generate_labels_file(database_name, 'test')
 
+        if prepare:
+            cls(database_name).prepare(target_size=target_size)
+
+
+    @property
+    def manifest(self):
+        """
+        Rows (split, cls, path) of manifest.csv, or None if the database has its
+        images in subfolders.
+        """
+        manifest_file = os.path.join(self.path, 'manifest.csv')
+        if self._manifest is None and os.path.isfile(manifest_file):
+            with open(manifest_file, encoding='UTF-8', newline='') as f:
+                reader = csv.reader(f)
+                next(reader)
+                self._manifest = [tuple(row) for row in reader]
+        return self._manifest
 
     @property
     def classes(self):
         """
         This method act like an attribute and return a list of classes in database.
         """
+        if self.manifest is not None:
+            # toutes les lignes : une classe trop petite peut n'avoir aucune image d'entrainement,
+            # comme en mode dossiers ou create cree tous les dossiers de classes
+            return sorted(set(classe for _, classe, _ in self.manifest))
         return sorted(os.listdir(os.path.join(self.path, 'train')))
 
+    def image_paths(self, image_subfolder, filenames):
+        """
+        Return the paths of images listed by list_images.
+        """
+        if self.manifest is not None:
+            sources = self._manifest_paths(image_subfolder)
+            return [sources[filename] for filename in filenames]
+        return [os.path.join(self.path, image_subfolder, filename) for filename in filenames]
+
+    def _manifest_paths(self, image_subfolder):
+        """
+        Map the '<classe>/<image>' filenames of a split of the manifest to the source paths.
+        """
+        return {
+            os.path.join(classe, os.path.basename(path)): path
+            for split, classe, path in self.manifest if split == image_subfolder
+        }
+
+
+    def shards_folder(self, image_subfolder):
+        """
+        Return the folder holding the shards of a subfolder.
+        """
+        return os.path.join(self.path, 'shards', image_subfolder)
+
+    def prepare(self, target_size=(150, 150), subfolders=('train', 'validation', 'test'), shard_size=SHARD_SIZE):
+        """
+        Write the resized images of each subfolder into a few large shards that
+        the loaders read instead of decoding every JPEG at every epoch.
+
+        Each subfolder gets a folder shards/<subfolder>/ with:
+            - images-00000.npy, ...: uint8 arrays of shape (n, height, width, 3).
+            - labels.npy: sparse label of every image, index in database.classes.
+            - meta.json: target size, classes, filenames and number of images per shard.
+
+        Images are resized like ImageDataGenerator does, so batches are the same.
+
+        Parameters:
+            - target_size: A tuple (height, width) used to resize images.
+            - subfolders: subfolders of the database to prepare.
+            - shard_size: number of images per shard.
+        """
+        for image_subfolder in subfolders:
+            folder = self.shards_folder(image_subfolder)
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+
+            filenames, labels = self.list_images(image_subfolder)
+            paths = self.image_paths(image_subfolder, filenames)
+            # signatures lues avant les images : une image modifiee pendant l'ecriture rend les shards perimes
+            signatures = [_file_signature(path) for path in paths]
+            shard_sizes = []
+            for start in range(0, len(filenames), shard_size):
+                batch = paths[start:start + shard_size]
+                # ecrit le shard au fur et a mesure, sans garder toutes les images en memoire
+                images = np.lib.format.open_memmap(
+                    os.path.join(folder, 'images-{:05d}.npy'.format(len(shard_sizes))),
+                    mode='w+', dtype=np.uint8, shape=(len(batch), target_size[0], target_size[1], 3)
+                )
+                for k, path in enumerate(batch):
+                    image = load_img(path, target_size=target_size)
+                    images[k] = img_to_array(image, dtype=np.uint8)
+                images.flush()
+                del images
+                shard_sizes.append(len(batch))
+
+            np.save(os.path.join(folder, 'labels.npy'), np.array(labels, dtype=np.int32))
+            # meta.json est ecrit en dernier, un shard incomplet n'est donc jamais lu
+            with open(os.path.join(folder, 'meta.json'), 'w', encoding='UTF-8') as f:
+                json.dump({
+                    'target_size': list(target_size),
+                    'classes': self.classes,
+                    'filenames': filenames,
+                    'signatures': signatures,
+                    'shard_sizes': shard_sizes
+                }, f)
+
+    def get_shards(self, image_subfolder, shuffle=True, batch_size=16, target_size=(150, 150), seed=None):
+        """
+        Return a ShardSequence over the shards of a subfolder, or None if the
+        subfolder hasn't been prepared with this target size and these classes,
+        or if its images have been added, removed, renamed or modified since.
+        """
+        meta_file = os.path.join(self.shards_folder(image_subfolder), 'meta.json')
+        if not os.path.isfile(meta_file):
+            return None
+        with open(meta_file, encoding='UTF-8') as f:
+            meta = json.load(f)
+        if tuple(meta['target_size']) != tuple(target_size) or meta['classes'] != self.classes:
+            return None
+        # des shards perimes donneraient des images absentes ou des labels decales
+        filenames = self.list_images(image_subfolder)[0]
+        if meta['filenames'] != filenames:
+            return None
+        # une image remplacee sous le meme nom change de taille ou de date de modification
+        paths = self.image_paths(image_subfolder, filenames)
+        if meta.get('signatures') != [_file_signature(path) for path in paths]:
+            return None
+        return ShardSequence(self.shards_folder(image_subfolder), meta, shuffle=shuffle, batch_size=batch_size,
+                             seed=seed, filepaths=self.image_paths(image_subfolder, meta['filenames']))
 
     @property
     def weights_filename(self):
@@ -134,16 +323,49 @@ class Database:
         """
         return os.path.isfile(self.weights_filename)
 
-    def get_images_generator(self, image_subfolder, shuffle=True, batch_size=16, target_size=(150, 150)):
+    def get_images_generator(self, image_subfolder, shuffle=True, batch_size=16, target_size=(150, 150), seed=None,
+                             shards=True):
         """
         Return a generator that will yield an infinite number of images.
 
+        If the subfolder has been prepared (see prepare), images are streamed from
+        its shards, epoch by epoch, instead of being decoded from the JPEG files.
+
         Parameters:
             - image_subfolder: Subfolder of the database where images will be picked.
             - shuffle: If true, randomize images order.
             - target_size: A tuple (width, length) used to resize yielded images.
             - batch_size: Number of images per chuncks.
+            - seed: seed of the shuffling.
+            - shards: if false, always decode the image files, even when shards exist.
         """
+        if shards:
+            shards = self.get_shards(image_subfolder, shuffle=shuffle, batch_size=batch_size,
+                                     target_size=target_size, seed=seed)
+            if shards is not None:
+                return shards
+
+        if self.manifest is not None:
+            # les images restent dans le dossier source, listees par le manifeste
+            filenames, labels = self.list_images(image_subfolder)
+            classes = self.classes
+            dataframe = pd.DataFrame({
+                'filename': self.image_paths(image_subfolder, filenames),
+                'class': [classes[label] for label in labels]
+            })
+            return ImageDataGenerator(
+                rescale=1./255
+            ).flow_from_dataframe(
+                dataframe,
+                directory=None,
+                classes=classes,
+                target_size=target_size,
+                shuffle=shuffle,
+                batch_size=batch_size,
+                class_mode='sparse',
+                seed=seed
+            )
+
         return ImageDataGenerator(
             rescale=1./255
         ).flow_from_directory(
@@ -151,13 +373,207 @@ class Database:
             target_size=target_size,
             shuffle=shuffle,
             batch_size=batch_size,
-            class_mode='sparse'
+            class_mode='sparse',
+            seed=seed
         )
 
+    def list_images(self, image_subfolder):
+        """
+        Return the images of a subfolder and their sparse labels, in the order
+        flow_from_directory lists them: classes sorted, then filenames sorted.
+
+        Parameters:
+            - image_subfolder: Subfolder of the database where images will be picked.
+
+        Returns:
+            - filenames: paths relative to the subfolder, as '<classe>/<image>',
+                see image_paths for the actual paths.
+            - labels: index of the class of each image in database.classes.
+        """
+        filenames, labels = [], []
+        if self.manifest is not None:
+            class_indices = {classe: label for label, classe in enumerate(self.classes)}
+            images = sorted(
+                (class_indices[classe], os.path.join(classe, os.path.basename(path)))
+                for split, classe, path in self.manifest
+                if split == image_subfolder and path.lower().endswith(IMAGE_EXTENSIONS)
+            )
+            return [filename for _, filename in images], [label for label, _ in images]
+
+        for label, classe in enumerate(self.classes):
+            class_folder = os.path.join(self.path, image_subfolder, classe)
+            if not os.path.isdir(class_folder):
+                continue
+            for root, _, files in sorted(os.walk(class_folder)):
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        path = os.path.join(root, name)
+                        filenames.append(os.path.relpath(path, os.path.join(self.path, image_subfolder)))
+                        labels.append(label)
+        return filenames, labels
+
+    def get_images_dataset(self, image_subfolder, shuffle=True, batch_size=16, target_size=(150, 150),
+                           cache=None, seed=None, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                           interpolation='nearest'):
+        """
+        Return a tf.data.Dataset yielding (images, labels) batches for one epoch.
+
+        Images are decoded and resized in parallel and prefetched while the model
+        runs, labels are the same sparse labels as get_images_generator.
+
+        Parameters:
+            - image_subfolder: Subfolder of the database where images will be picked.
+            - shuffle: If true, randomize images order, differently at each epoch.
+            - batch_size: Number of images per chuncks.
+            - target_size: A tuple (height, width) used to resize yielded images.
+            - cache: None to decode images at every epoch, '' to keep decoded images
+                in memory, or a filename to keep them on disk after the first epoch.
+                Images are cached as uint8, cached epochs are shuffled from a buffer
+                of SHUFFLE_BUFFER images.
+            - seed: seed of the shuffling, the order of the epochs is then deterministic.
+            - num_parallel_calls: number of images decoded in parallel.
+            - interpolation: resize method, 'nearest' like ImageDataGenerator.
+        """
+        filenames, labels = self.list_images(image_subfolder)
+        paths = self.image_paths(image_subfolder, filenames)
+
+        pil_pattern = r'.*\.({})'.format('|'.join(extension[1:] for extension in PIL_EXTENSIONS))
+
+        def load(path, label):
+            image = tf.cond(
+                tf.strings.regex_full_match(tf.strings.lower(path), pil_pattern),
+                lambda: tf.numpy_function(_read_image, [path], tf.uint8),
+                lambda: tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+            )
+            image.set_shape([None, None, 3])
+            image = tf.image.resize(image, target_size, method=interpolation)
+            if image.dtype != tf.uint8:
+                image = tf.saturate_cast(tf.round(image), tf.uint8)
+            return image, label
+
+        def rescale(image, label):
+            return tf.cast(image, tf.float32) / 255., label
+
+        dataset = tf.data.Dataset.from_tensor_slices((paths, tf.constant(labels, dtype=tf.int32)))
+        if shuffle:
+            # melange les chemins plutot que les images decodees, moins couteux en memoire.
+            # Avec un cache, l'ordre est fige a la premiere epoque : les classes y sont
+            # melangees une fois pour toutes, les epoques suivantes sont melangees apres
+            dataset = dataset.shuffle(max(1, len(paths)), seed=seed, reshuffle_each_iteration=cache is None)
+        dataset = dataset.map(load, num_parallel_calls=num_parallel_calls, deterministic=True)
+        if cache is not None:
+            # le cache garde des uint8, la conversion en float32 se fait apres
+            dataset = dataset.cache(cache)
+            if shuffle:
+                dataset = dataset.shuffle(max(1, min(len(paths), SHUFFLE_BUFFER)), seed=seed,
+                                          reshuffle_each_iteration=True)
+        dataset = dataset.map(rescale, num_parallel_calls=num_parallel_calls, deterministic=True)
+
+        return dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+    def get_images(self, image_subfolder, backend='keras', **kwargs):
+        """
+        Return the images of a subfolder with the selected loader.
+
+        Parameters:
+            - backend: 'keras' for get_images_generator, 'tf.data' for get_images_dataset.
+            - kwargs: passed to the loader.
+        """
+        if backend == 'keras':
+            return self.get_images_generator(image_subfolder, **kwargs)
+        elif backend == 'tf.data':
+            return self.get_images_dataset(image_subfolder, **kwargs)
+        raise ValueError("Unknown backend {}, expected 'keras' or 'tf.data'".format(backend))
+
     def __len__(self):
         return len(self.classes)
 
 
+def _file_signature(path):
+    """
+    Return a string that changes when the file is modified: its modification
+    time and size.
+    """
+    stat = os.stat(path)
+    return '{}:{}'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def _read_image(path):
+    """
+    Read an image tf.io.decode_image doesn't support as an uint8 RGB array.
+    """
+    return img_to_array(load_img(path.decode()), dtype=np.uint8)
+
+
+class ShardSequence(Sequence):
+    """
+    Batches of (images, labels) read from the memory mapped shards written by
+    Database.prepare, with the attributes of ImageDataGenerator iterators that
+    the classifier uses (filenames, filepaths, classes, samples).
+    """
+    def __init__(self, folder, meta, shuffle=True, batch_size=16, seed=None, filepaths=None):
+        self.shards = [
+            np.load(os.path.join(folder, 'images-{:05d}.npy'.format(k)), mmap_mode='r')
+            for k in range(len(meta['shard_sizes']))
+        ]
+        self.offsets = np.cumsum([0] + meta['shard_sizes'])
+        self.classes = np.load(os.path.join(folder, 'labels.npy'))
+        self.class_indices = {classe: k for k, classe in enumerate(meta['classes'])}
+        self.filenames = meta['filenames']
+        # chemins des images d'origine, donnes par Database.get_shards
+        self.filepaths = filepaths
+        self.samples = len(self.filenames)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.index_array = np.arange(self.samples)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return -(-self.samples // self.batch_size)
+
+    def __getitem__(self, idx):
+        indices = self.index_array[idx * self.batch_size:(idx + 1) * self.batch_size]
+        images = np.empty((len(indices),) + self.shards[0].shape[1:], dtype=np.float32) if self.shards else None
+        # lit les images shard par shard, par indices croissants pour suivre le fichier
+        shard_of = np.searchsorted(self.offsets, indices, side='right') - 1
+        for shard in np.unique(shard_of):
+            positions = np.flatnonzero(shard_of == shard)
+            order = positions[np.argsort(indices[positions])]
+            images[order] = self.shards[shard][indices[order] - self.offsets[shard]]
+        images *= 1. / 255
+        return images, self.classes[indices]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.index_array = self.random.permutation(self.samples)
+
+
+def iter_image_paths(sources):
+    """
+    Yield the paths of the images of each source, lazily so that listing
+    millions of images doesn't hold them all in memory.
+
+    Parameters:
+        - sources: folders (walked recursively, in sorted order), text files
+            listing one image path per line, or image paths.
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for root, folders, files in os.walk(source):
+                folders.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        elif source.lower().endswith(IMAGE_EXTENSIONS):
+            yield source
+        else:
+            with open(source, encoding='UTF-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield line.strip()
+
+
 if __name__ == '__main__':
     db = Database.create(
         'database', 
@@ -0,0 +1,62 @@
+import itertools
+import time
+
+from .database import Database
+
+
+def _images_per_second(batches, n_batches):
+    """
+    Consume n_batches batches of an iterable and return the number of images per second.
+    """
+    n_images = 0
+    start = time.perf_counter()
+    for images, _ in itertools.islice(batches, n_batches):
+        n_images += len(images)
+    elapsed = time.perf_counter() - start
+    return n_images / elapsed if elapsed else float('inf')
+
+
+def benchmark_loaders(database, image_subfolder='train', batch_size=16, target_size=(150, 150), epochs=2,
+                      cache_file=None):
+    """
+    Measure the images/sec of each loader over complete epochs of a subfolder:
+    the keras generator decoding the image files, the shards if the subfolder
+    has been prepared, and tf.data.
+
+    Parameters:
+        - database: database object defined in this library.
+        - image_subfolder: Subfolder of the database where images will be picked.
+        - epochs: number of epochs timed, epochs after the first one read from the cache.
+        - cache_file: if set, also time the tf.data loader with a disk cache in this file.
+
+    Returns:
+        - a dict {loader: [images/sec of each epoch]}
+    """
+    n_images = len(database.list_images(image_subfolder)[0])
+    n_batches = -(-n_images // batch_size)
+    loader = {'batch_size': batch_size, 'target_size': target_size}
+    results = {}
+
+    # le generateur keras est infini, une epoque correspond a n_batches lots
+    generator = database.get_images_generator(image_subfolder, shards=False, **loader)
+    results['keras'] = [_images_per_second(generator, n_batches) for _ in range(epochs)]
+
+    # les shards ne sont mesures que si la base a ete preparee pour cette taille
+    shards = database.get_shards(image_subfolder, **loader)
+    if shards is not None:
+        results['shards'] = [_images_per_second(shards, n_batches) for _ in range(epochs)]
+
+    caches = {'tf.data': None, 'tf.data (memory cache)': ''}
+    if cache_file:
+        caches['tf.data (disk cache)'] = cache_file
+    for name, cache in caches.items():
+        dataset = database.get_images_dataset(image_subfolder, cache=cache, seed=0, **loader)
+        results[name] = [_images_per_second(dataset, n_batches) for _ in range(epochs)]
+
+    return results
+
+
+if __name__ == '__main__':
+    database = Database('database')
+    for name, speeds in benchmark_loaders(database).items():
+        print('{:<24} {}'.format(name, ', '.join('{:.1f} images/sec'.format(s) for s in speeds)))
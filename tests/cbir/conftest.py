@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import sys
+import os
+
+
+# the cbir modules import each other by module name
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'src', 'cbir'))
+
+
+@pytest.fixture(scope='session', autouse=True)
+def workdir(tmp_path_factory):
+  ''' run in a scratch directory, the cbir modules make their cache and result dirs in the working directory '''
+  path = tmp_path_factory.mktemp('cbir')
+  cwd = os.getcwd()
+  os.chdir(str(path))
+  yield path
+  os.chdir(cwd)
+
+
+@pytest.fixture
+def image():
+  ''' a small random RGB image, its sizes don't divide evenly into slices '''
+  return np.random.RandomState(0).randint(0, 256, size=(37, 53, 3)).astype(np.uint8)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+
+def _index(n, d, density=0.05, seed=0):
+  from feature_store import FeatureStore
+  from evaluate import SampleIndex
+  rng = np.random.RandomState(seed)
+  hist = (rng.rand(n, d) * (rng.rand(n, d) < density)).astype(np.float32)
+  return SampleIndex(FeatureStore.from_arrays(hist, np.arange(n).astype(str), rng.randint(0, 10, n)))
+
+
+@pytest.mark.parametrize('d_type', ['d1', 'cosine'])
+def test_search_ranks_candidates_exactly(d_type):
+  from ann import IVFIndex
+  from evaluate import distance_matrix
+  index = _index(2000, 300)
+  ann = IVFIndex(n_lists=16, n_probe=2, n_iter=5, d_type=d_type).build(index)
+
+  for row in [0, 7, 1999]:
+    q_hist, q_img = index.hist[row], index.img[row]
+    rows, dis = ann.search(q_hist, q_img=q_img, depth=20)
+    candidates = np.unique(ann._candidates(np.asarray(q_hist)))
+    candidates = candidates[index.img[candidates] != q_img]
+    exact = distance_matrix(q_hist, index, d_type=d_type)[0][candidates]
+    np.testing.assert_array_equal(rows, candidates[np.lexsort((candidates, exact))][:20])
+    np.testing.assert_allclose(dis, np.sort(exact)[:20], rtol=1e-5, atol=1e-6)
+
+
+def test_search_scores_few_candidates_with_high_recall():
+  # wall-clock latencies are left out, they depend on the load of the machine
+  from feature_store import FeatureStore
+  from evaluate import SampleIndex
+  from ann import IVFIndex, recall_report
+  rng = np.random.RandomState(0)
+  centers, cluster = rng.rand(40, 64) * 4, rng.randint(0, 40, 4000)
+  hist = (centers[cluster] + rng.rand(4000, 64)).astype(np.float32)
+  index = SampleIndex(FeatureStore.from_arrays(hist, np.arange(4000).astype(str), cluster % 10))
+
+  ann = IVFIndex(n_lists=40, n_probe=4, n_iter=10).build(index)
+  report = recall_report(ann, n_queries=50, verbose=False)
+  assert report['candidates'] < len(index) / 4.
+  assert report['recall'] >= 0.95
+
+
+@pytest.mark.parametrize('name', ['PQIndex', 'SparseIndex'])
+def test_recall_report_of_compressed_index(name):
+  import compressed
+  from ann import recall_report
+  index = _index(1000, 64)
+  ann = getattr(compressed, name)(**({'n_subspaces': 8, 'n_iter': 5} if name == 'PQIndex' else {})).build(index)
+
+  with pytest.raises(ValueError):
+    recall_report(ann, n_queries=5, verbose=False)
+  report = recall_report(ann, n_queries=20, verbose=False, reference=index)
+  assert report['candidates'] == len(index)
+  if name == 'SparseIndex':
+    assert report['recall'] == 1
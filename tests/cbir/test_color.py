@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import itertools
+import pytest
+
+
+def reference_count_hist(img, n_bin, bins, channel):
+  ''' per pixel histogram of the original Color._count_hist '''
+  bins_idx = {key: idx for idx, key in enumerate(itertools.product(np.arange(n_bin), repeat=channel))}
+  hist = np.zeros(n_bin ** channel)
+  q = img.copy()
+  for idx in range(len(bins)-1):
+    q[(img >= bins[idx]) & (img < bins[idx+1])] = idx
+  for h in range(q.shape[0]):
+    for w in range(q.shape[1]):
+      hist[bins_idx[tuple(q[h, w])]] += 1
+  return hist
+
+
+def reference_histogram(img, n_bin, type, n_slice):
+  ''' the original Color.histogram, region by region '''
+  height, width, channel = img.shape
+  bins = np.linspace(0, 256, n_bin+1, endpoint=True)
+  if type == 'global':
+    hist = reference_count_hist(img, n_bin, bins, channel)
+  else:
+    hist = np.zeros((n_slice, n_slice, n_bin ** channel))
+    h_slice = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
+    w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
+    for hs in range(n_slice):
+      for ws in range(n_slice):
+        img_r = img[h_slice[hs]:h_slice[hs+1], w_slice[ws]:w_slice[ws+1]]
+        hist[hs][ws] = reference_count_hist(img_r, n_bin, bins, channel)
+  hist /= np.sum(hist)
+  return hist.flatten()
+
+
+@pytest.mark.parametrize('n_bin', [4, 12])
+def test_global_histogram_matches_reference(image, n_bin):
+  from color import Color
+  hist = Color().histogram(image, n_bin=n_bin, type='global')
+  np.testing.assert_allclose(hist, reference_histogram(image, n_bin, 'global', None))
+
+
+@pytest.mark.parametrize('n_bin,n_slice', [(4, 2), (12, 3), (6, 5)])
+def test_region_histogram_matches_reference(image, n_bin, n_slice):
+  from color import Color
+  hist = Color().histogram(image, n_bin=n_bin, type='region', n_slice=n_slice)
+  np.testing.assert_allclose(hist, reference_histogram(image, n_bin, 'region', n_slice))
+
+
+def test_sweep_matches_histogram(image):
+  from color import Color
+  color = Color()
+  hists = color.sweep(image, n_bins=(4, 8, 12), n_slices=(2, 3))
+  for (n_bin, n_slice), hist in hists.items():
+    np.testing.assert_allclose(hist, color.histogram(image, n_bin=n_bin, type='region', n_slice=n_slice))
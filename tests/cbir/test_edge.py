@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+
+def reference_conv(img, stride, kernels):
+  ''' sliding window product of the original Edge._conv '''
+  H, W, C = img.shape
+  conv_kernels = np.tile(np.expand_dims(kernels, axis=3), (1, 1, 1, C))
+  sh, sw = stride
+  kn, kh, kw, kc = conv_kernels.shape
+  hh = int((H - kh) / sh + 1)
+  ww = int((W - kw) / sw + 1)
+  hist = np.zeros(kn)
+  for idx, k in enumerate(conv_kernels):
+    for h in range(hh):
+      for w in range(ww):
+        hist[idx] += np.sum(img[h*sh:h*sh+kh, w*sw:w*sw+kw] * k)
+  return hist / np.sum(hist)
+
+
+def reference_histogram(img, stride, type, n_slice):
+  ''' the original Edge.histogram, region by region '''
+  from edge import edge_kernels
+  height, width, channel = img.shape
+  if type == 'global':
+    hist = reference_conv(img, stride, edge_kernels)
+  else:
+    hist = np.zeros((n_slice, n_slice, edge_kernels.shape[0]))
+    h_slice = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
+    w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
+    for hs in range(n_slice):
+      for ws in range(n_slice):
+        img_r = img[h_slice[hs]:h_slice[hs+1], w_slice[ws]:w_slice[ws+1]]
+        hist[hs][ws] = reference_conv(img_r, stride, edge_kernels)
+  hist /= np.sum(hist)
+  return hist.flatten()
+
+
+@pytest.mark.parametrize('stride', [(1, 1), (2, 2), (2, 3)])
+def test_global_histogram_matches_reference(image, stride):
+  from edge import Edge
+  hist = Edge().histogram(image, stride=stride, type='global')
+  np.testing.assert_allclose(hist, reference_histogram(image, stride, 'global', None))
+
+
+@pytest.mark.parametrize('stride,n_slice', [((1, 1), 2), ((2, 2), 4), ((2, 3), 3)])
+def test_region_histogram_matches_reference(image, stride, n_slice):
+  from edge import Edge
+  hist = Edge().histogram(image, stride=stride, type='region', n_slice=n_slice)
+  np.testing.assert_allclose(hist, reference_histogram(image, stride, 'region', n_slice))
+
+
+def test_make_samples_uses_configured_stride(image):
+  import edge
+  hist = edge.Edge().histogram(image, **edge.Edge().histogram_kwargs())
+  np.testing.assert_allclose(hist, reference_histogram(image, edge.stride, edge.h_type, edge.n_slice))
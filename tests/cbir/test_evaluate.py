@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import warnings
+import pytest
+
+
+def _store(hist, n_classes=4, seed=0, dtype=np.float32):
+  from feature_store import FeatureStore
+  n = len(hist)
+  return FeatureStore.from_arrays(hist, np.arange(n).astype(str), np.random.RandomState(seed).randint(0, n_classes, n),
+                                  dtype=dtype)
+
+
+@pytest.mark.parametrize('d_type', ['d1', 'cosine'])
+@pytest.mark.parametrize('depth', [1, 5, 40, None])
+def test_all_pairs_matches_infer_with_ties_and_nan(d_type, depth):
+  from evaluate import SampleIndex, infer, evaluate_all_pairs
+  # few distinct values make ties at every depth, zero rows have undefined cosine distances
+  hist = np.random.RandomState(1).randint(0, 3, size=(200, 4)).astype(np.float32)
+  hist[::17] = 0
+  store = _store(hist)
+  index = SampleIndex(store)
+
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    expected = np.array([infer(s, samples=index, depth=depth, d_type=d_type)[0] for s in store.as_samples()])
+    APs = evaluate_all_pairs(index, depths=[depth], d_type=d_type)[depth]
+
+  got = np.zeros(len(store))
+  for cls, aps in APs.items():
+    got[index.cls == cls] = aps
+  np.testing.assert_allclose(got, expected, atol=1e-12)
+
+
+metrics = ['d1', 'd2', 'square', 'd2-norm', 'd3', 'd4', 'd5', 'd6', 'd7', 'd8', 'cosine']
+
+
+@pytest.fixture
+def sparse_pair():
+  rng = np.random.RandomState(2)
+  Q = rng.rand(6, 20) * (rng.rand(6, 20) < 0.3)
+  X = rng.rand(9, 20) * (rng.rand(9, 20) < 0.3)
+  Q[1] = 0
+  X[[0, 4]] = 0
+  return Q, X
+
+
+@pytest.mark.parametrize('d_type', metrics)
+def test_distance_kernels_agree(sparse_pair, d_type):
+  from scipy import sparse
+  from evaluate import SampleIndex, distance, distance_matrix, sparse_distance_matrix, elementwise_metrics, dot_metrics
+  Q, X = sparse_pair
+  store = _store(X, dtype=np.float64)
+
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    expected = np.array([[distance(q, x, d_type=d_type) for x in X] for q in Q])
+    on_nonzeros = np.array([[distance(sparse.csr_matrix(q), (np.flatnonzero(x), x[x != 0]), d_type=d_type) for x in X]
+                            for q in Q])
+    dense = distance_matrix(Q, SampleIndex(store, sparse=False), d_type=d_type)
+    if d_type in elementwise_metrics + dot_metrics:
+      on_csr = sparse_distance_matrix(Q, sparse.csr_matrix(X), d_type=d_type)
+    else:
+      with pytest.raises(ValueError):
+        sparse_distance_matrix(Q, sparse.csr_matrix(X), d_type=d_type)
+      on_csr = expected
+
+  for got in (on_nonzeros, dense, on_csr):
+    np.testing.assert_allclose(got, expected, rtol=1e-10, atol=1e-12)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+
+def _stores():
+  from feature_store import FeatureStore
+  rng = np.random.RandomState(0)
+  imgs = np.array(['img%d' % k for k in range(30)])
+  cls = ['a', 'b', 'c'] * 10
+  # b misses img3 and lists its images in another order, c is stored as uint16
+  order = rng.permutation([k for k in range(30) if k != 3])
+  a = FeatureStore.from_arrays(rng.rand(30, 4), imgs, cls)
+  b = FeatureStore.from_arrays(rng.rand(29, 3), imgs[order], [cls[k] for k in order])
+  c = FeatureStore.from_arrays(rng.rand(30, 5), imgs, cls, precision='uint16')
+  return {'a': a, 'b': b, 'c': c}
+
+
+@pytest.mark.parametrize('names', [['a', 'c'], ['a', 'b'], ['b', 'c', 'a'], ['c', 'b']])
+def test_joined_matrix_matches_copy(names):
+  from feature_store import join_stores, JoinedMatrix
+  stores = [_stores()[name] for name in names]
+  copied, dropped = join_stores(stores)
+  joined, lazy_dropped = join_stores(stores, copy=False)
+
+  assert isinstance(joined.hist, JoinedMatrix)
+  assert dropped == lazy_dropped
+  assert (copied.img == joined.img).all() and (copied.cls == joined.cls).all()
+  assert joined.hist.shape == copied.hist.shape
+  np.testing.assert_array_equal(np.asarray(joined.hist), copied.hist)
+  np.testing.assert_array_equal(joined.hist[3:11], copied.hist[3:11])
+  np.testing.assert_array_equal(joined.hist[5], copied.hist[5])
+  ids, cols = np.array([1, 4, 2]), np.array([0, 5])
+  np.testing.assert_array_equal(joined.hist[np.ix_(ids, cols)], copied.hist[np.ix_(ids, cols)])
+  np.testing.assert_array_equal([s['hist'] for s in joined.as_samples()], copied.hist)
+
+
+def test_registry_joins_each_combination_on_its_own_features():
+  from registry import FeatureRegistry
+  from feature_store import FeatureStore
+  from evaluate import infer
+  registry = FeatureRegistry.__new__(FeatureRegistry)
+  registry.stores = _stores()
+
+  # only b misses an image
+  store, dropped = registry.join(['a', 'c'])
+  assert len(store) == 30 and dropped == []
+  store, dropped = registry.join(['a', 'b'])
+  assert len(store) == 29 and dropped == ['img3']
+  assert registry.select(['a']) is registry.stores['a']
+
+  samples = registry.make_samples(['c', 'a'])
+  store = samples.store
+  copied = FeatureStore(np.asarray(store.hist), store.img, store.cls_id, store.classes).as_samples()
+  for query in samples[:5]:
+    assert infer(query, samples=samples, depth=5) == infer(query, samples=copied, depth=5)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+class _Database(object):
+
+  def __init__(self, paths):
+    self.data = pd.DataFrame({'img': paths, 'cls': ['a'] * len(paths)})
+
+  def get_data(self):
+    return self.data
+
+
+@pytest.fixture
+def db(tmp_path):
+  paths = []
+  for i in range(5):
+    path = tmp_path / ('%d.jpg' % i)
+    path.write_bytes(b'%d' % i)
+    paths.append(str(path))
+  return _Database(paths)
+
+
+def _extract(paths):
+  _extract.calls.append(list(paths))
+  return np.array([[1. / 3, int(p[-5])] for p in paths])
+
+
+@pytest.mark.parametrize('saved, requested, extracted', [
+  ('float32', 'float64', True),
+  ('float32', 'float16', False),
+  ('float64', 'float32', False),
+  ('float16', 'uint16', True),
+])
+def test_cache_is_only_converted_to_lower_precision(db, tmp_path, saved, requested, extracted):
+  from feature_store import FeatureCache
+  path = str(tmp_path / 'cache')
+  _extract.calls = []
+  FeatureCache(path, config={}, precision=saved).update(db, _extract, verbose=False)
+  store = FeatureCache(path, config={}, precision=requested).update(db, _extract, verbose=False)
+
+  assert store.precision == requested
+  assert len(_extract.calls) == (2 if extracted else 1)
+  if requested == 'float64':
+    assert store.hist[0, 0] == 1. / 3
+
+
+def test_benchmark_needs_float64_reference(tmp_path):
+  from feature_store import FeatureStore
+  from precision import benchmark
+  hist = np.random.RandomState(0).rand(50, 8)
+  store = FeatureStore.from_arrays(hist, np.arange(50).astype(str), ['a', 'b'] * 25, precision='float64')
+  report = benchmark(store, str(tmp_path), precisions=('float64', 'float32'), verbose=False)
+  assert report['float64']['max_error'] == 0
+  assert 0 < report['float32']['max_error'] < 1e-7
+
+  with pytest.raises(AssertionError):
+    benchmark(FeatureStore.from_arrays(hist, store.img, ['a', 'b'] * 25), str(tmp_path), verbose=False)
+
+
+@pytest.mark.parametrize('precision', ['float64', 'float32', 'float16', 'uint16'])
+def test_edge_features_round_trip(image, tmp_path, precision):
+  # edge region histograms are signed kernel responses
+  from edge import Edge
+  from feature_store import FeatureStore
+  hist = np.stack([Edge().histogram(image[k:], stride=(1, 1), type='region', n_slice=3) for k in range(4)])
+  assert (hist < 0).any()
+
+  store = FeatureStore.from_arrays(hist, np.arange(4).astype(str), ['a'] * 4, precision=precision)
+  store.save(str(tmp_path / precision))
+  loaded = FeatureStore.load(str(tmp_path / precision))
+
+  assert loaded.precision == precision
+  span = (hist.max(axis=1) - np.minimum(hist.min(axis=1), 0))[:, None]
+  tolerance = {'float64': 0, 'float32': 1e-7, 'float16': 1e-3, 'uint16': 1. / 65535}[precision]
+  assert (np.absolute(np.asarray(loaded.hist, dtype=np.float64) - hist) <= tolerance * span).all()
+
+
+def test_uint16_keeps_zeros_of_positive_rows():
+  from precision import QuantizedMatrix
+  hist = np.array([[0, 1, 2.5], [0, 0, 0], [-1, 0, 3]])
+  decoded = QuantizedMatrix.encode(hist)[:]
+  assert (decoded[:2][hist[:2] == 0] == 0).all()
+  np.testing.assert_allclose(decoded, hist, atol=4. / 65535)